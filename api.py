@@ -34,67 +34,118 @@ import io
 import numpy as np
 from PIL import Image
 from facial_detection import detect_faces
+import coalesce
 import mergeGrid
+import profiling
+import rate_limiter
+import records
 
 # Create a Flask app instance
 app = Flask(__name__)
 
+# Identical detection and moderation requests in flight share a single analysis
+analyses = coalesce.SingleFlight()
+
+
+def throttled_response(e):
+    # Rekognition is still throttling after the limiter retries: tell the caller when to come back
+    response = jsonify({"error": str(e)})
+    response.headers["Retry-After"] = str(max(1, int(round(e.retry_after))))
+    return response, 429
+
+
+def manifest_not_found_response(e):
+    # The manifest_id of the request does not match any stored grid
+    return jsonify({"error": str(e)}), 404
+
 
 @app.route("/merge-images", methods=["POST"])
+@profiling.profiled
 def merge_images():
     # Get the JSON data from the request body
     data = request.get_json()
     bucket_name = data.get("bucket_name")
     prefix = data.get("prefix")
-    grid_size = data.get("grid_size")
+    grid_size = data.get("grid_size", [4, 8])
 
-    # Call the merge_images_from_s3 function from the mergeGrid module
-    result = mergeGrid.merge_images_from_s3(bucket_name, prefix, grid_size)
+    # Call the merge_images_from_s3 function from the mergeGrid module, which reuses the grid if it already exists
+    manifest = mergeGrid.merge_images_from_s3(bucket_name, prefix, grid_size)
+
+    # Return the manifest of the grid, whose manifest_id the other endpoints accept
+    return jsonify(dict(manifest, message=f"Success - {len(manifest['cells'])} images merged!"))
 
-    return "Success - 32 images merged!"
 
 
 # Define a route for the endpoint "/detect_faces" with HTTP POST method
 @app.route("/detect_faces", methods=["POST"])
+@profiling.profiled
 def detect_faces_api():
     # Check if the content type of the request is "application/json"
     if request.content_type != "application/json":
         # Return an error message with HTTP status code 400 (Bad Request) if the content type is invalid
         return jsonify({"error": "Invalid content type, expected application/json"}), 400
 
-    # Check if the required parameters "bucket_name" and "prefix" are present in the request data
-    if "bucket_name" not in request.json or "prefix" not in request.json:
+    # Check if the required parameters "bucket_name" and "prefix" (or "manifest_id") are present in the request data
+    if "bucket_name" not in request.json or ("prefix" not in request.json and "manifest_id" not in request.json):
         # Return an error message with HTTP status code 400 (Bad Request) if the required parameters are missing
-        return jsonify({"error": "Missing required parameters: bucket_name, prefix"}), 400
+        return jsonify({"error": "Missing required parameters: bucket_name, prefix or manifest_id"}), 400
 
-    # Extract the values of "bucket_name" and "prefix" from the request data    
+    # Extract the values of "bucket_name" and "prefix" or "manifest_id" from the request data    
     bucket_name = request.json['bucket_name']
-    prefix = request.json['prefix']
+    prefix = request.json.get('prefix')
+    manifest_id = request.json.get('manifest_id')
 
+    def analyse():
+        # Reuse the grid of the manifest if one is given, otherwise build (or reuse) the grid of the prefix
+        manifest = mergeGrid.load_manifest(bucket_name, manifest_id) if manifest_id else None
+        return detect_faces(bucket_name, prefix, manifest)
 
     # Try to run the facial detection function and catch any exceptions
     try:
-        response = detect_faces(bucket_name, prefix)
+        response = analyses.do(coalesce.request_key(
+            "detect_faces", bucket_name=bucket_name, prefix=prefix, manifest_id=manifest_id), analyse)
+    except rate_limiter.RekognitionThrottled as e:
+        return throttled_response(e)
+    except mergeGrid.ManifestNotFound as e:
+        return manifest_not_found_response(e)
     except Exception as e:
         # Return an error message with HTTP status code 500 (Internal Server Error) if an exception occurs
         return jsonify({"error": str(e)}), 500
 
     # Return the response from the facial detection function as a JSON object
-    return jsonify(response)
+    return records.json_response(response)
 
 
 import moderation_detection
 
 @app.route("/moderation", methods=["POST"])
+@profiling.profiled
 def moderation_detection_api():
     bucket = request.args.get("bucket")
     img_path = request.args.get("img_path")
     bucket = request.json['bucket']
-    img_path = request.json['img_path']
+    img_path = request.json.get('img_path')
+    manifest_id = request.json.get('manifest_id')
+    if img_path is None and manifest_id is None:
+        return jsonify({"error": "Missing required parameters: bucket, img_path or manifest_id"}), 400
+
+    def analyse():
+        if manifest_id is None:
+            return moderation_detection.moderation(bucket, img_path)
+        # Moderate the grid of the manifest and map each result to the user key of its cell
+        manifest = mergeGrid.load_manifest(bucket, manifest_id)
+        return mergeGrid.attach_user_keys(
+            moderation_detection.moderation(bucket, manifest["grid_key"], manifest["grid_size"]), manifest)
     
-    results = moderation_detection.moderation(bucket, img_path)
+    try:
+        results = analyses.do(coalesce.request_key(
+            "moderation", bucket=bucket, img_path=img_path, manifest_id=manifest_id), analyse)
+    except rate_limiter.RekognitionThrottled as e:
+        return throttled_response(e)
+    except mergeGrid.ManifestNotFound as e:
+        return manifest_not_found_response(e)
     
-    return jsonify(results)
+    return records.json_response(results)
 
   
 
@@ -103,16 +154,42 @@ def moderation_detection_api():
 from detect_custom import show_custom_labels, display_image
 
 @app.route('/detect_custom_labels', methods=['POST'])
+@profiling.profiled
 def detect_custom_labels():
     bucket = request.json['bucket']
-    photo = request.json['photo']
+    photo = request.json.get('photo')
+    manifest_id = request.json.get('manifest_id')
     min_confidence = request.json.get('min_confidence', 7) # Default value set to 50
     model_version = request.json['model']
-    response = show_custom_labels(bucket, photo, min_confidence, model_version)
+    if photo is None and manifest_id is None:
+        return jsonify({"error": "Missing required parameters: bucket, photo or manifest_id"}), 400
 
-    result_array = display_image(bucket, photo, response)
-
-    return {'grid_positions_and_labels': result_array}
+    manifest = None
+    try:
+        if manifest_id is not None:
+            # Analyse the grid of the manifest
+            manifest = mergeGrid.load_manifest(bucket, manifest_id)
+            photo = manifest["grid_key"]
+        response = show_custom_labels(bucket, photo, min_confidence, model_version)
+    except rate_limiter.RekognitionThrottled as e:
+        return throttled_response(e)
+    except mergeGrid.ManifestNotFound as e:
+        return manifest_not_found_response(e)
+
+    if manifest is None:
+        result_array = display_image(bucket, photo, response)
+    else:
+        # Locate the labels in the layout of the grid and map each one to the user key of its cell
+        result_array = mergeGrid.attach_user_keys(
+            display_image(bucket, photo, response, manifest["grid_size"]), manifest)
+
+    return records.json_response({'grid_positions_and_labels': result_array})
+
+
+# Queueing delay, throttling counters and current refill rate of the Rekognition rate limiter
+@app.route('/rekognition-limits', methods=['GET'])
+def rekognition_limits():
+    return jsonify(rate_limiter.stats())
 
 
 
@@ -0,0 +1,170 @@
+"""
+Benchmark of the result records (records.py) against the dicts the API used to build.
+
+Builds synthetic Rekognition DetectFaces and DetectModerationLabels responses for a number of
+4x8 grids, then times building the results and serialising them to JSON, and serialising
+already built face results on their own:
+
+- dicts: per-face dicts with tuple age ranges and raw ModerationLabels lists,
+  serialised with json.dumps using the same options as Flask's jsonify
+- records: FaceRecord / ModerationRecord objects serialised with records.dumps
+- batch: the faces of every grid in a FaceBatch (struct of arrays) serialised at once
+
+It also checks that both paths produce the same JSON and reports the memory held by the results.
+
+Usage: python bench_records.py [number of grids]
+"""
+
+# bench_records.py
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from records import FaceBatch, FaceRecord, ModerationRecord, dumps
+
+EMOTIONS = ["HAPPY", "SAD", "ANGRY", "CONFUSED", "DISGUSTED", "SURPRISED", "CALM", "FEAR"]
+MODERATION_LABELS = [("Explicit Nudity", ""), ("Nudity", "Explicit Nudity"),
+                     ("Violence", ""), ("Graphic Violence Or Gore", "Violence")]
+ROWS, COLS = 4, 8
+REPEATS = 5
+
+
+def fake_detect_faces_response(rng):
+    faces = []
+    for position in range(ROWS * COLS):
+        low = rng.randint(10, 60)
+        faces.append({
+            'BoundingBox': {'Left': (position % COLS + 0.3) / COLS, 'Top': (position // COLS + 0.3) / ROWS},
+            'AgeRange': {'Low': low, 'High': low + rng.randint(3, 12)},
+            'Emotions': [{'Type': emotion, 'Confidence': rng.uniform(0, 100)} for emotion in EMOTIONS],
+        })
+    return {'FaceDetails': faces}
+
+
+def fake_moderation_labels(rng):
+    return [{'Confidence': rng.uniform(50, 100), 'Name': name, 'ParentName': parent}
+            for name, parent in rng.sample(MODERATION_LABELS, 2)]
+
+
+def faces_as_dicts(response):
+    # The face data as detect_faces used to build it
+    face_data = []
+    for face in response['FaceDetails']:
+        grid_position = int(face['BoundingBox']['Top'] * ROWS) * COLS + int(face['BoundingBox']['Left'] * COLS)
+        emotions = sorted(face['Emotions'], key=lambda x: -x['Confidence'])
+        face_data.append({
+            'grid_position': grid_position,
+            'age_range': (face['AgeRange']['Low'], face['AgeRange']['High']),
+            'Highest Confidence Emotion': {
+                'Confidence': emotions[0]['Confidence'],
+                'Type': emotions[0]['Type']
+            }
+        })
+    return sorted(face_data, key=lambda x: x['grid_position'])
+
+
+def faces_as_records(response):
+    # The face data as detect_faces builds it now
+    face_data = []
+    for face in response['FaceDetails']:
+        grid_position = int(face['BoundingBox']['Top'] * ROWS) * COLS + int(face['BoundingBox']['Left'] * COLS)
+        emotion = max(face['Emotions'], key=lambda x: x['Confidence'])
+        face_data.append(FaceRecord(grid_position, face['AgeRange']['Low'], face['AgeRange']['High'],
+                                    emotion['Confidence'], emotion['Type']))
+    face_data.sort(key=lambda x: x.grid_position)
+    return face_data
+
+
+def jsonify_dumps(value):
+    # json.dumps with the options of Flask's default JSON provider
+    return json.dumps(value, ensure_ascii=True, sort_keys=True, separators=(",", ":"))
+
+
+def timed(function):
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def held_memory(function):
+    tracemalloc.start()
+    result = function()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def build_batch(face_responses):
+    batch = FaceBatch()
+    for grid_id, response in enumerate(face_responses):
+        batch.extend(grid_id, faces_as_records(response))
+    return batch
+
+
+def main(grids):
+    rng = random.Random(0)
+    face_responses = [fake_detect_faces_response(rng) for _ in range(grids)]
+    moderation_responses = [[(position, fake_moderation_labels(rng)) for position in rng.sample(range(ROWS * COLS), 3)]
+                            for _ in range(grids)]
+
+    benchmarks = {
+        "faces": {
+            "dicts": lambda: [jsonify_dumps(faces_as_dicts(response)) for response in face_responses],
+            "records": lambda: [dumps(faces_as_records(response)) for response in face_responses],
+            "batch": lambda: build_batch(face_responses).to_json(),
+        },
+        "moderation": {
+            "dicts": lambda: [jsonify_dumps([{"GridPos": position, "Labels": labels} for position, labels in grid])
+                              for grid in moderation_responses],
+            "records": lambda: [dumps([ModerationRecord.from_api(position, labels) for position, labels in grid])
+                                for grid in moderation_responses],
+        },
+    }
+    # Serialisation alone, on results built beforehand
+    face_dicts = [faces_as_dicts(response) for response in face_responses]
+    face_records = [faces_as_records(response) for response in face_responses]
+    face_batch = build_batch(face_responses)
+    benchmarks["faces, json only"] = {
+        "dicts": lambda: [jsonify_dumps(grid) for grid in face_dicts],
+        "records": lambda: [dumps(grid) for grid in face_records],
+        "batch": face_batch.to_json,
+    }
+    memory = {
+        "dicts": lambda: [faces_as_dicts(response) for response in face_responses],
+        "records": lambda: [faces_as_records(response) for response in face_responses],
+        "batch": lambda: build_batch(face_responses),
+    }
+
+    # Every path must produce the same JSON documents
+    faces = [json.loads(document) for document in benchmarks["faces"]["dicts"]()]
+    assert [json.loads(document) for document in benchmarks["faces"]["records"]()] == faces
+    assert json.loads(benchmarks["faces"]["batch"]()) == {str(i): grid for i, grid in enumerate(faces)}
+    # A grid without faces is kept, and a grid extended twice keeps all its faces under one key
+    batch = build_batch(face_responses[:1])
+    batch.extend("empty", [])
+    batch.extend(0, faces_as_records(face_responses[0]))
+    assert json.loads(batch.to_json()) == {"0": faces[0] + faces[0], "empty": []}
+    assert dumps(batch.records(0)) == dumps(faces_as_records(face_responses[0]) * 2)
+    moderation = [json.loads(document) for document in benchmarks["moderation"]["dicts"]()]
+    assert [json.loads(document) for document in benchmarks["moderation"]["records"]()] == moderation
+
+    print(f"{grids} grids of {ROWS}x{COLS}, best of {REPEATS} runs")
+    print(f"{'results':<18}{'path':<10}{'seconds':>10}{'grids/s':>12}{'speedup':>10}{'memory':>12}")
+    for results, paths in benchmarks.items():
+        baseline = None
+        for path, function in paths.items():
+            elapsed, _ = timed(function)
+            baseline = baseline or elapsed
+            held = f"{held_memory(memory[path]) / 1024:.0f} KiB" if results == "faces" else "-"
+            print(f"{results:<18}{path:<10}{elapsed:>10.4f}{grids / elapsed:>12.0f}{baseline / elapsed:>9.2f}x{held:>12}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
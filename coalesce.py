@@ -0,0 +1,98 @@
+"""
+Single-flight coalescing of identical analyses.
+
+Upstream retries and fan-out often send the same /detect_faces or /moderation request several
+times within a second. SingleFlight.do(key, function) runs the function once per key: requests
+arriving while it is in flight wait for it and all receive its result (or its exception), and
+requests arriving within `result_ttl` seconds after it finished get the same result without
+running it again. Failures are not kept in the result window. The caller that ran the function
+gets its exception as raised; each waiting caller gets its own copy of it (same type and
+message) chained to the original, so the original traceback is not extended by every waiter.
+
+request_key() builds the key of a request from its JSON parameters, which may be unhashable
+(lists, objects). The values are otherwise used as sent: a prefix with and without a trailing
+"/" are different S3 listings ("users" also lists "users2/"), so they are not merged.
+
+Coalescing is per process: each worker process has its own in-flight table.
+"""
+
+# coalesce.py
+import collections
+import copy
+import json
+import os
+import threading
+import time
+
+RESULT_TTL = float(os.environ.get("COALESCE_RESULT_TTL", "1.0"))
+
+
+class CoalescedError(Exception):
+    # Raised in the waiting callers when the exception of the shared call cannot be copied
+    pass
+
+
+def request_key(endpoint, **parameters):
+    # Hashable key of a request, whatever the JSON types of its parameters
+    return json.dumps([endpoint, parameters], sort_keys=True, separators=(",", ":"), default=str)
+
+
+def _waiter_error(error):
+    # A fresh exception for one waiting caller, of the same type as the error when it can be copied
+    try:
+        return copy.copy(error)
+    except Exception:
+        return CoalescedError(f"Coalesced call failed: {error!r}")
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, result_ttl=RESULT_TTL):
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+        # key -> (expiry, result), in order of expiry
+        self._results = collections.OrderedDict()
+
+    def _expire(self, now):
+        while self._results:
+            key, (expiry, _) = next(iter(self._results.items()))
+            if expiry > now:
+                break
+            del self._results[key]
+
+    def do(self, key, function):
+        # Run function() once for all the concurrent callers with the same key
+        with self._lock:
+            self._expire(time.monotonic())
+            if key in self._results:
+                return self._results[key][1]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise _waiter_error(call.error) from call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None and self.result_ttl > 0:
+                    self._results[key] = (time.monotonic() + self.result_ttl, call.result)
+            call.done.set()
+        return call.result
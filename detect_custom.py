@@ -2,20 +2,24 @@ import numpy as np
 import boto3
 import io
 from PIL import Image, ImageDraw, ImageColor, ImageFont, ExifTags
+import profiling
+import rate_limiter
+from records import CustomLabelRecord
 
 
 
 
-def display_image(bucket,photo,response):
+def display_image(bucket,photo,response,grid_size=(4, 8)):
     # Load image from S3 bucket
     s3_connection = boto3.resource('s3')
 
     s3_object = s3_connection.Object(bucket,photo)
-    s3_response = s3_object.get()
+    with profiling.stage("s3_download"):
+        s3_response = s3_object.get()
 
 
-    #read file directly from s3 bucket
-    stream = io.BytesIO(s3_response['Body'].read())
+        #read file directly from s3 bucket
+        stream = io.BytesIO(s3_response['Body'].read())
     image=Image.open(stream)
 
     #image dimensions
@@ -27,8 +31,7 @@ def display_image(bucket,photo,response):
     resultArray = []
     if isinstance(response, dict) and 'CustomLabels' in response:
         gridPositionArray = []
-        cols = 8
-        rows = 4
+        rows, cols = grid_size
         x = 0
         y = 0
         gridPositionCount = 0
@@ -93,7 +96,7 @@ def display_image(bucket,photo,response):
                         
                         if itemLeft >= box['leftTop'][0] and itemRight < box['rightTop'][0]:
                             if itemTop >= box['leftTop'][1] and itemBottom < box['leftBottom'][1]:
-                                resultArray.append({"gridPos":box['gridPos'], "label": point['Label']})
+                                resultArray.append(CustomLabelRecord(box['gridPos'], point['Label']))
                          
     return resultArray
 
@@ -102,7 +105,8 @@ def show_custom_labels(bucket,photo, min_confidence,model):
     client=boto3.client('rekognition')
 
     #Call DetectCustomLabels
-    response = client.detect_custom_labels(Image={'S3Object': {'Bucket': bucket, 'Name': photo}},
+    response = rate_limiter.call('DetectCustomLabels', client.detect_custom_labels,
+        Image={'S3Object': {'Bucket': bucket, 'Name': photo}},
         MinConfidence = min_confidence,
         ProjectVersionArn = model)
 
@@ -0,0 +1,317 @@
+"""
+Local stand-ins for the S3 and Rekognition clients used by the API, for the load generator (loadgen.py).
+
+FakeAWS keeps S3 objects in memory and answers DetectFaces, DetectModerationLabels and
+DetectCustomLabels by looking at the pixels of the image, so the API code runs unchanged:
+installed() swaps boto3.client, boto3.resource and boto3.setup_default_session for the fakes.
+
+Synthetic user photos are grey noise with a solid block in the middle whose colour encodes
+whether the user should be flagged: green 250 for flagged users, below 200 for the others,
+always with red and blue 10, while the noise stays between 60 and 200. That block survives the
+resizing done when the grid is composed and the cropping done by the moderation recursion, so
+the fake Rekognition can tell which cells hold a face and which ones are flagged. Red and blue
+are equal so the photos look the same whether they are decoded as RGB (PIL) or BGR (OpenCV).
+
+Rekognition calls sleep for a latency drawn from a configurable distribution and are throttled
+(ThrottlingException) above a transactions-per-second limit or at a random rate. Every S3 and
+Rekognition call is counted, in total and for the request running in the current thread; throttled
+calls are also counted under the rekognition_throttled service.
+"""
+
+# fake_aws.py
+import collections
+import contextlib
+import hashlib
+import io
+import random
+import threading
+import time
+
+import boto3
+import numpy as np
+from botocore.exceptions import ClientError
+from PIL import Image
+
+FLAGGED_GREEN = 250
+MARKER_RED_BLUE = 10
+PHOTO_SIZE = (200, 240)
+
+
+def latency(spec):
+    # Build a latency sampler from "constant:SECONDS", "uniform:LOW:HIGH" or "lognormal:MEDIAN:SIGMA"
+    kind, *values = spec.split(":")
+    values = [float(value) for value in values]
+    if kind == "constant":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda rng: values[0] * rng.lognormvariate(0, values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def synthetic_photo(rng, flagged):
+    # Grey noise with a solid marker block covering the middle of the photo
+    width, height = PHOTO_SIZE
+    noise = np.array([rng.randrange(60, 200) for _ in range(width * height // 64)], dtype=np.uint8)
+    pixels = np.repeat(noise.reshape(height // 8, width // 8), 8, axis=0).repeat(8, axis=1)
+    pixels = np.stack([pixels] * 3, axis=-1)
+    pixels[height // 4:3 * height // 4, width // 4:3 * width // 4] = (
+        MARKER_RED_BLUE, FLAGGED_GREEN if flagged else rng.randrange(20, 200), MARKER_RED_BLUE)
+    stream = io.BytesIO()
+    Image.fromarray(pixels).save(stream, format="PNG")
+    return stream.getvalue()
+
+
+def compose_grid(photos, grid_size=(4, 8)):
+    # Compose the photos the same way the API does, one per cell, row by row
+    rows, cols = grid_size
+    images = [Image.open(io.BytesIO(photo)).convert("RGB") for photo in photos]
+    cell_width, cell_height = images[0].size
+    grid = Image.new("RGB", (cell_width * cols, cell_height * rows))
+    for i, image in enumerate(images):
+        grid.paste(image, ((i % cols) * cell_width, (i // cols) * cell_height))
+    stream = io.BytesIO()
+    grid.save(stream, format="PNG")
+    return stream.getvalue()
+
+
+def _markers(pixels):
+    # Masks of the pixels belonging to the marker block of a flagged or clean user
+    red, green, blue = (pixels[..., channel].astype(int) for channel in range(3))
+    marker = (np.abs(red - MARKER_RED_BLUE) <= 4) & (np.abs(blue - MARKER_RED_BLUE) <= 4)
+    flagged = np.abs(green - FLAGGED_GREEN) <= 4
+    return marker & flagged, marker & ~flagged
+
+
+def _client_error(code, message, operation):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class FakeS3:
+    def __init__(self, aws):
+        self._aws = aws
+
+    def list_objects(self, Bucket, Prefix="", **kwargs):
+        self._aws.count("s3", "ListObjects")
+        objects = self._aws.bucket(Bucket)
+        contents = [{"Key": key, "ETag": etag, "Size": len(body)}
+                    for key, (body, etag) in sorted(objects.items()) if key.startswith(Prefix)]
+        return {"Contents": contents} if contents else {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._aws.count("s3", "GetObject")
+        body, etag = self._aws.read(Bucket, Key, "GetObject")
+        return {"Body": io.BytesIO(body), "ETag": etag, "ContentLength": len(body)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._aws.count("s3", "HeadObject")
+        body, etag = self._aws.read(Bucket, Key, "HeadObject")
+        return {"ETag": etag, "ContentLength": len(body)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._aws.count("s3", "PutObject")
+        return {"ETag": self._aws.write(Bucket, Key, Body)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._aws.count("s3", "DeleteObject")
+        self._aws.bucket(Bucket).pop(Key, None)
+        return {}
+
+
+class _FakeS3Object:
+    def __init__(self, s3, bucket, key):
+        self._s3 = s3
+        self.bucket_name = bucket
+        self.key = key
+
+    def get(self):
+        return self._s3.get_object(Bucket=self.bucket_name, Key=self.key)
+
+
+class FakeS3Resource:
+    def __init__(self, aws):
+        self._s3 = FakeS3(aws)
+
+    def Object(self, bucket, key):
+        return _FakeS3Object(self._s3, bucket, key)
+
+
+class FakeRekognition:
+    def __init__(self, aws):
+        self._aws = aws
+
+    def _image(self, Image, operation):
+        s3_object = Image["S3Object"]
+        body, _ = self._aws.read(s3_object["Bucket"], s3_object["Name"], operation)
+        return np.asarray(_open(body))
+
+    def _cells(self, pixels, grid_size=(4, 8)):
+        # Cells whose centre shows a marker block, with whether the user is flagged
+        rows, cols = grid_size
+        height, width = pixels.shape[:2]
+        flagged, clean = _markers(pixels)
+        cells = []
+        for row in range(rows):
+            for col in range(cols):
+                y, x = int((row + 0.5) * height / rows), int((col + 0.5) * width / cols)
+                if flagged[y, x] or clean[y, x]:
+                    cells.append((row, col, bool(flagged[y, x])))
+        return cells
+
+    def detect_faces(self, Image, Attributes=None, **kwargs):
+        self._aws.rekognition_call("DetectFaces")
+        pixels = self._image(Image, "DetectFaces")
+        rng = self._aws.rng()
+        faces = []
+        for row, col, _ in self._cells(pixels):
+            low = rng.randint(15, 60)
+            faces.append({
+                "BoundingBox": {"Left": (col + 0.3) / 8, "Top": (row + 0.2) / 4, "Width": 0.4 / 8, "Height": 0.5 / 4},
+                "AgeRange": {"Low": low, "High": low + rng.randint(3, 12)},
+                "Emotions": [{"Type": emotion, "Confidence": rng.uniform(0, 100)}
+                             for emotion in ("HAPPY", "SAD", "CALM", "SURPRISED")],
+                "Confidence": 99.9,
+            })
+        return {"FaceDetails": faces}
+
+    def detect_moderation_labels(self, Image, **kwargs):
+        self._aws.rekognition_call("DetectModerationLabels")
+        pixels = self._image(Image, "DetectModerationLabels")
+        flagged, _ = _markers(pixels[::4, ::4])
+        if not flagged.any():
+            return {"ModerationLabels": []}
+        return {"ModerationLabels": [
+            {"Confidence": 97.5, "Name": "Explicit Nudity", "ParentName": "", "TaxonomyLevel": 1}]}
+
+    def detect_custom_labels(self, Image, MinConfidence=None, ProjectVersionArn=None, **kwargs):
+        self._aws.rekognition_call("DetectCustomLabels")
+        pixels = self._image(Image, "DetectCustomLabels")
+        labels = []
+        for row, col, is_flagged in self._cells(pixels):
+            if is_flagged:
+                labels.append({"Name": "flagged", "Confidence": 91.0, "Geometry": {"BoundingBox": {
+                    "Left": (col + 0.25) / 8, "Top": (row + 0.25) / 4, "Width": 0.5 / 8, "Height": 0.5 / 4}}})
+        return {"CustomLabels": labels}
+
+
+def _open(body):
+    return Image.open(io.BytesIO(body)).convert("RGB")
+
+
+class FakeAWS:
+    def __init__(self, rekognition_latency="constant:0", s3_latency="constant:0",
+                 rekognition_tps=None, throttle_rate=0.0, seed=0):
+        self.rekognition_latency = latency(rekognition_latency)
+        self.s3_latency = latency(s3_latency)
+        self.rekognition_tps = rekognition_tps
+        self.throttle_rate = throttle_rate
+        self.calls = collections.Counter()
+        self._seed = seed
+        self._rng = random.Random(seed)
+        self._buckets = collections.defaultdict(dict)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Recent Rekognition call times, for the transactions-per-second limit
+        self._recent = collections.deque()
+
+    def rng(self):
+        with self._lock:
+            return random.Random(self._rng.random())
+
+    # S3 storage
+
+    def bucket(self, name):
+        return self._buckets[name]
+
+    def read(self, bucket, key, operation):
+        try:
+            return self._buckets[bucket][key]
+        except KeyError:
+            raise _client_error("404" if operation == "HeadObject" else "NoSuchKey", f"{key} not found", operation)
+
+    def write(self, bucket, key, body):
+        if hasattr(body, "read"):
+            body = body.read()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        self._buckets[bucket][key] = (bytes(body), etag)
+        return etag
+
+    def _photos(self, bucket, key, users, flag_rate, flag_cells):
+        # The same synthetic users every time for a given seed, bucket and key
+        rng = random.Random(f"{self._seed}:{bucket}:{key}")
+        return [synthetic_photo(rng, i in flag_cells or rng.random() < flag_rate) for i in range(users)]
+
+    def seed_prefix(self, bucket, prefix, users=32, flag_rate=0.0, flag_cells=()):
+        # Upload one synthetic photo per user under the prefix
+        for i, photo in enumerate(self._photos(bucket, prefix, users, flag_rate, flag_cells)):
+            self.write(bucket, f"{prefix}user-{i:03d}.png", photo)
+
+    def seed_grid(self, bucket, key, users=32, flag_rate=0.0, flag_cells=()):
+        # Upload an already composed grid of synthetic users
+        self.write(bucket, key, compose_grid(self._photos(bucket, key, users, flag_rate, flag_cells)))
+
+    # Call accounting
+
+    def count(self, service, operation):
+        with self._lock:
+            self.calls[(service, operation)] += 1
+            delay = self.s3_latency(self._rng) if service == "s3" else 0
+        if delay:
+            time.sleep(delay)
+        scope = getattr(self._local, "calls", None)
+        if scope is not None:
+            scope[(service, operation)] += 1
+
+    def rekognition_call(self, operation):
+        self.count("rekognition", operation)
+        now = time.monotonic()
+        with self._lock:
+            sample = self._rng.random()
+            delay = self.rekognition_latency(self._rng)
+            throttled = sample < self.throttle_rate
+            if self.rekognition_tps:
+                while self._recent and now - self._recent[0] > 1.0:
+                    self._recent.popleft()
+                throttled = throttled or len(self._recent) >= self.rekognition_tps
+            if not throttled:
+                self._recent.append(now)
+        if throttled:
+            # Under a service of its own, so the throttled call is not counted twice in the Rekognition total
+            self.count("rekognition_throttled", operation)
+            raise _client_error("ThrottlingException", "Rate exceeded", operation)
+        time.sleep(delay)
+
+    @contextlib.contextmanager
+    def track(self):
+        # Count the calls made by the current thread inside the block
+        self._local.calls = collections.Counter()
+        try:
+            yield self._local.calls
+        finally:
+            self._local.calls = None
+
+    # boto3 replacements
+
+    def client(self, service, *args, **kwargs):
+        if service == "s3":
+            return FakeS3(self)
+        if service == "rekognition":
+            return FakeRekognition(self)
+        raise ValueError(f"No local stand-in for {service}")
+
+    def resource(self, service, *args, **kwargs):
+        if service == "s3":
+            return FakeS3Resource(self)
+        raise ValueError(f"No local stand-in for {service}")
+
+    @contextlib.contextmanager
+    def installed(self):
+        # Route every boto3 client and resource created inside the block to the stand-ins
+        saved = boto3.client, boto3.resource, boto3.setup_default_session
+        boto3.client, boto3.resource = self.client, self.resource
+        boto3.setup_default_session = lambda *args, **kwargs: None
+        try:
+            yield self
+        finally:
+            boto3.client, boto3.resource, boto3.setup_default_session = saved
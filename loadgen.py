@@ -0,0 +1,257 @@
+"""
+End-to-end load generator for the API, running against the local AWS stand-ins of fake_aws.py.
+
+The Flask app runs in process with boto3 routed to FakeAWS. Each tenant gets 32 synthetic user
+photos under users/<tenant>/ and an already composed grid at grids/<tenant>.png in the fake
+bucket. Requests to /merge-images, /detect_faces, /moderation and /detect_custom_labels are then
+sent at a target rate (open loop: a request is sent on schedule whether or not the previous
+ones have finished, and its latency is measured from the time it was scheduled).
+
+Instead of generated load, a recorded trace can be replayed. A trace has one JSON object per
+line: {"at": seconds from the start, "endpoint": "/moderation", "body": {...}}. Buckets, prefixes
+and grid keys referenced by the trace are seeded before the replay. --record saves the
+generated requests as a trace.
+
+The report gives, per endpoint, latency percentiles, error rate and the number of S3 and
+Rekognition calls per request and per user. --output saves it as JSON and --compare prints it
+next to a report saved earlier, for before and after comparisons. --sweep runs the generated
+load at several rates to show where throughput levels off.
+
+Usage:
+    python loadgen.py --rate 4 --duration 30
+    python loadgen.py --sweep 1,2,4,8,16 --duration 20 --rekognition-latency lognormal:0.2:0.5
+    python loadgen.py --replay trace.jsonl --speed 2 --output after.json --compare before.json
+"""
+
+# loadgen.py
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from fake_aws import FakeAWS
+
+BUCKET = "loadgen.bucket"
+USERS_PER_GRID = 32
+MODEL_ARN = "arn:aws:rekognition:local:000000000000:project/loadgen/version/fake/1"
+ENDPOINTS = ["/merge-images", "/detect_faces", "/moderation", "/detect_custom_labels"]
+
+
+def request_body(endpoint, tenant):
+    prefix = f"users/{tenant}/"
+    grid = f"grids/{tenant}.png"
+    if endpoint == "/merge-images":
+        return {"bucket_name": BUCKET, "prefix": prefix, "grid_size": [4, 8]}
+    if endpoint == "/detect_faces":
+        return {"bucket_name": BUCKET, "prefix": prefix}
+    if endpoint == "/moderation":
+        return {"bucket": BUCKET, "img_path": grid}
+    return {"bucket": BUCKET, "photo": grid, "min_confidence": 50, "model": MODEL_ARN}
+
+
+def generate_trace(rate, duration, tenants, mix, seed):
+    # Poisson arrivals at the target rate, endpoints drawn according to the mix
+    rng = random.Random(seed)
+    endpoints, weights = zip(*mix.items())
+    trace = []
+    at = rng.expovariate(rate)
+    while at < duration:
+        endpoint = rng.choices(endpoints, weights)[0]
+        trace.append({"at": at, "endpoint": endpoint, "body": request_body(endpoint, rng.randrange(tenants))})
+        at += rng.expovariate(rate)
+    return trace
+
+
+def seed_trace(aws, trace, flag_rate, flag_cells):
+    # Make sure every prefix and grid referenced by the trace exists in the fake bucket
+    prefixes, grids = set(), set()
+    for entry in trace:
+        body = entry["body"]
+        if "prefix" in body:
+            prefixes.add((body["bucket_name"], body["prefix"]))
+        if "img_path" in body or "photo" in body:
+            grids.add((body["bucket"], body.get("img_path") or body.get("photo")))
+    for bucket, prefix in sorted(prefixes):
+        aws.seed_prefix(bucket, prefix, USERS_PER_GRID, flag_rate, flag_cells)
+    for bucket, key in sorted(grids):
+        aws.seed_grid(bucket, key, USERS_PER_GRID, flag_rate, flag_cells)
+
+
+def percentile(values, share):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(share * len(values))) - 1))]
+
+
+def run(app, aws, trace, workers, speed=1.0):
+    # Send the trace to the app on schedule and collect one result per request
+    results = []
+    results_lock = threading.Lock()
+
+    def send(entry, scheduled):
+        client = app.test_client()
+        error = None
+        with aws.track() as calls:
+            try:
+                response = client.post(entry["endpoint"], json=entry["body"])
+                status = response.status_code
+                if status >= 400:
+                    error = response.get_data(as_text=True)[:200]
+            except Exception as e:
+                status, error = None, f"{type(e).__name__}: {e}"
+        with results_lock:
+            results.append({"endpoint": entry["endpoint"], "status": status, "error": error,
+                            "latency": time.monotonic() - scheduled, "calls": dict(calls)})
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for entry in sorted(trace, key=lambda entry: entry["at"]):
+            scheduled = start + entry["at"] / speed
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, entry, scheduled)
+    return results, time.monotonic() - start
+
+
+def summarise(results, elapsed):
+    report = {"elapsed": elapsed, "requests": len(results),
+              "throughput": len(results) / elapsed if elapsed else 0.0, "endpoints": {}}
+    by_endpoint = collections.defaultdict(list)
+    for result in results:
+        by_endpoint[result["endpoint"]].append(result)
+    for endpoint, endpoint_results in sorted(by_endpoint.items()):
+        latencies = sorted(result["latency"] for result in endpoint_results)
+        errors = [result for result in endpoint_results if result["error"] is not None]
+        calls = collections.Counter()
+        for result in endpoint_results:
+            for (service, operation), count in result["calls"].items():
+                calls[service] += count
+                calls[f"{service}:{operation}"] += count
+        count = len(endpoint_results)
+        report["endpoints"][endpoint] = {
+            "requests": count,
+            "errors": len(errors),
+            "error_rate": len(errors) / count,
+            "first_error": errors[0]["error"] if errors else None,
+            "p50": percentile(latencies, 0.50),
+            "p90": percentile(latencies, 0.90),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1],
+            "calls_per_request": {name: value / count for name, value in sorted(calls.items())},
+            "calls_per_user": {name: value / (count * USERS_PER_GRID) for name, value in sorted(calls.items())},
+        }
+    return report
+
+
+def print_report(report, before=None):
+    print(f"{report['requests']} requests in {report['elapsed']:.1f}s, {report['throughput']:.2f} requests/s")
+    header = f"{'endpoint':<30}{'requests':>9}{'errors':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'s3/user':>9}{'rek/user':>9}"
+    print(header)
+    for endpoint, stats in report["endpoints"].items():
+        rows = [("", stats)]
+        if before and endpoint in before["endpoints"]:
+            rows = [("before", before["endpoints"][endpoint]), ("after", stats)]
+        for label, values in rows:
+            per_user = values["calls_per_user"]
+            name = f"{endpoint} {label}".strip()
+            print(f"{name:<30}{values['requests']:>9}{values['error_rate']:>8.1%}"
+                  f"{values['p50']:>9.3f}{values['p90']:>9.3f}{values['p99']:>9.3f}{values['max']:>9.3f}"
+                  f"{per_user.get('s3', 0):>9.3f}{per_user.get('rekognition', 0):>9.3f}")
+        if stats["first_error"]:
+            print(f"    first error: {stats['first_error']}")
+
+
+def parse_mix(spec):
+    mix = {}
+    for item in spec.split(","):
+        name, weight = item.split("=")
+        endpoint = "/" + name.strip().lstrip("/")
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint in mix: {name}")
+        mix[endpoint] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the Facial Analysis API against local AWS stand-ins")
+    parser.add_argument("--rate", type=float, default=2.0, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of generated load")
+    parser.add_argument("--sweep", help="comma separated rates to run one after the other")
+    parser.add_argument("--tenants", type=int, default=10, help="number of distinct grids of users")
+    parser.add_argument("--mix", default="merge-images=0,detect_faces=1,moderation=1,detect_custom_labels=1",
+                        help="relative weight of each endpoint")
+    parser.add_argument("--workers", type=int, default=16, help="concurrent requests in flight")
+    parser.add_argument("--rekognition-latency", default="lognormal:0.15:0.4",
+                        help="constant:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--s3-latency", default="constant:0.005")
+    parser.add_argument("--rekognition-tps", type=float, help="fake account limit, throttles above it")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of Rekognition calls throttled at random")
+    parser.add_argument("--flag-rate", type=float, default=0.05, help="share of users flagged by moderation")
+    parser.add_argument("--flag-cells", default="", help="comma separated cells flagged in every grid")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", help="trace to replay instead of generated load")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor")
+    parser.add_argument("--record", help="save the generated trace to this file")
+    parser.add_argument("--output", help="save the report as JSON")
+    parser.add_argument("--compare", help="report saved earlier to compare with")
+    args = parser.parse_args()
+
+    # Keep the rate limiter state of the harness away from the one of a real deployment
+    os.environ.setdefault("REKOGNITION_LIMITER_DIR", tempfile.mkdtemp(prefix="loadgen_limiter_"))
+    import api
+    api.app.logger.setLevel(logging.CRITICAL)
+
+    aws = FakeAWS(args.rekognition_latency, args.s3_latency, args.rekognition_tps, args.throttle_rate, args.seed)
+    flag_cells = {int(cell) for cell in args.flag_cells.split(",") if cell}
+    mix = parse_mix(args.mix)
+    before = json.load(open(args.compare)) if args.compare else None
+
+    with aws.installed():
+        if args.replay:
+            with open(args.replay) as f:
+                trace = [json.loads(line) for line in f if line.strip()]
+            seed_trace(aws, trace, args.flag_rate, flag_cells)
+            results, elapsed = run(api.app, aws, trace, args.workers, args.speed)
+            report = summarise(results, elapsed)
+            print_report(report, before)
+        elif args.sweep:
+            report = {"sweep": []}
+            print(f"{'offered/s':>10}{'achieved/s':>12}{'users/s':>10}{'p50':>9}{'p99':>9}{'errors':>8}")
+            for rate in [float(rate) for rate in args.sweep.split(",")]:
+                trace = generate_trace(rate, args.duration, args.tenants, mix, args.seed)
+                seed_trace(aws, trace, args.flag_rate, flag_cells)
+                results, elapsed = run(api.app, aws, trace, args.workers)
+                step = summarise(results, elapsed)
+                step["offered"] = rate
+                report["sweep"].append(step)
+                latencies = sorted(result["latency"] for result in results)
+                errors = sum(result["error"] is not None for result in results)
+                print(f"{rate:>10.2f}{step['throughput']:>12.2f}{step['throughput'] * USERS_PER_GRID:>10.1f}"
+                      f"{percentile(latencies, 0.5):>9.3f}{percentile(latencies, 0.99):>9.3f}"
+                      f"{errors / max(1, len(results)):>8.1%}")
+        else:
+            trace = generate_trace(args.rate, args.duration, args.tenants, mix, args.seed)
+            if args.record:
+                with open(args.record, "w") as f:
+                    f.writelines(json.dumps(entry) + "\n" for entry in trace)
+            seed_trace(aws, trace, args.flag_rate, flag_cells)
+            results, elapsed = run(api.app, aws, trace, args.workers)
+            report = summarise(results, elapsed)
+            print_report(report, before)
+
+    report["aws_calls"] = {f"{service}:{operation}": count for (service, operation), count in sorted(aws.calls.items())}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
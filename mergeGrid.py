@@ -1,6 +1,138 @@
+"""
+Composes the user images stored under an S3 prefix into a single grid image.
+
+Each grid is stored under a key derived from the hash of its ordered inputs (the key and
+ETag of every object listed under the prefix, except folder markers, empty objects and grids)
+and of the grid layout: grids/<manifest_id>.png. Next to it, grids/<manifest_id>.json is a
+small manifest that maps each cell of the grid to its source key and ETag:
+
+    {
+        "manifest_id": "3f2a...",
+        "bucket": "rekognition.bucket",
+        "grid_key": "grids/3f2a....png",
+        "grid_size": [4, 8],
+        "cells": [{"cell": 0, "key": "32users/dummyUser-000.jpg", "etag": "\"9b2c...\""}, ...],
+        "skipped": [{"key": "32users/notes.txt", "etag": "\"04f1...\"", "reason": "decode"}]
+    }
+
+Listed objects that could not be used are recorded under "skipped", with the reason "decode"
+(not an image) or "download" (the download failed). Both the lookup and the stored manifest
+hash the same listing, so a prefix holding a non-image object still reuses its grid.
+
+When the same images are merged again with the same layout, the existing grid is reused:
+only the S3 listing and the manifest are read and the grid image is checked with a HEAD
+request, nothing is downloaded or composed. A grid whose image is gone (e.g. expired by a
+lifecycle rule on grids/) is forgotten: merging rebuilds it, and its manifest_id is no
+longer found by the endpoints. A grid
+that skipped an image because its download failed is rebuilt instead, as that failure may
+not happen again.
+The endpoints accept a manifest_id instead of a prefix or image key, and attach_user_keys()
+maps their results back to the user keys.
+"""
+
+# mergeGrid.py
 import boto3
 from PIL import Image
 import io
+import collections
+import hashlib
+import json
+import re
+import threading
+from botocore.exceptions import ClientError
+import profiling
+
+# S3 prefix of the grid images and their manifests
+GRID_PREFIX = "grids/"
+# Part of the hash, to be bumped whenever the composition of the grid changes
+COMPOSER_VERSION = 1
+# Manifests kept in memory; they never change once written
+MANIFEST_CACHE_SIZE = 256
+
+_manifests = collections.OrderedDict()
+_manifests_lock = threading.Lock()
+
+
+class ManifestNotFound(Exception):
+    pass
+
+
+def grid_key(manifest_id):
+    return f"{GRID_PREFIX}{manifest_id}.png"
+
+
+def manifest_key(manifest_id):
+    return f"{GRID_PREFIX}{manifest_id}.json"
+
+
+def compute_manifest_id(bucket_name, sources, grid_size):
+    # Hash of the ordered (key, ETag) of the source images and of the grid layout
+    description = json.dumps({
+        "version": COMPOSER_VERSION,
+        "bucket": bucket_name,
+        "grid_size": list(grid_size),
+        "sources": [list(source) for source in sources],
+    }, separators=(",", ":"))
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+
+def _is_source(content):
+    # Folder markers ("prefix/"), empty objects and merged grids are not user images
+    return (not content['Key'].endswith("/") and content.get('Size', 1) > 0
+            and not content['Key'].startswith(GRID_PREFIX))
+
+
+def _is_missing(error):
+    return error.response.get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound")
+
+
+def load_manifest(bucket_name, manifest_id, s3=None):
+    # Get a manifest from the in-process cache or from S3, provided its grid image still exists
+    if not re.fullmatch(r"[0-9a-f]{64}", str(manifest_id)):
+        raise ManifestNotFound(f"Invalid manifest id: {manifest_id}")
+
+    with _manifests_lock:
+        manifest = _manifests.get((bucket_name, manifest_id))
+        if manifest is not None:
+            _manifests.move_to_end((bucket_name, manifest_id))
+
+    s3 = s3 or boto3.client("s3")
+    try:
+        with profiling.stage("s3_manifest"):
+            if manifest is None:
+                object = s3.get_object(Bucket=bucket_name, Key=manifest_key(manifest_id))
+                manifest = json.loads(object['Body'].read())
+            s3.head_object(Bucket=bucket_name, Key=manifest["grid_key"])
+    except ClientError as e:
+        if _is_missing(e):
+            with _manifests_lock:
+                _manifests.pop((bucket_name, manifest_id), None)
+            raise ManifestNotFound(f"No grid for manifest {manifest_id} in bucket {bucket_name}")
+        raise e
+
+    _cache_manifest(manifest)
+    return manifest
+
+
+def _cache_manifest(manifest):
+    with _manifests_lock:
+        _manifests[(manifest["bucket"], manifest["manifest_id"])] = manifest
+        while len(_manifests) > MANIFEST_CACHE_SIZE:
+            _manifests.popitem(last=False)
+
+
+def cell_keys(manifest):
+    # Source key of each cell of the grid
+    return {cell["cell"]: cell["key"] for cell in manifest["cells"]}
+
+
+def attach_user_keys(results, manifest):
+    # Set the user_key of each result record from the cell it was found in
+    keys = cell_keys(manifest)
+    for result in results:
+        result.user_key = keys.get(result.cell)
+    return results
+
 
 def merge_images_from_s3(bucket_name , prefix, grid_size):
     # Create clients for S3 and Rekognition services
@@ -8,85 +140,113 @@ def merge_images_from_s3(bucket_name , prefix, grid_size):
 
     try:
         # Get a list of S3 objects with the specified prefix
-        response = s3.list_objects(Bucket=bucket_name, Prefix=prefix)
+        with profiling.stage("s3_list"):
+            response = s3.list_objects(Bucket=bucket_name, Prefix=prefix)
     except Exception as e:
         # Print error message if an exception occurs while listing objects
         print(f"Error listing objects in S3 bucket: {bucket_name} with prefix: {prefix}. Error: {str(e)}")
         raise e
 
-    # Extract the keys (file names) of the objects from the response
-    keys = [content['Key'] for content in response['Contents']]
+    # Extract the keys (file names) and ETags of the user images from the response
+    listed = [(content['Key'], content['ETag']) for content in response['Contents'] if _is_source(content)]
+    manifest_id = compute_manifest_id(bucket_name, listed, grid_size)
+
+    # Reuse the grid if these images were already merged with this layout
+    try:
+        manifest = load_manifest(bucket_name, manifest_id, s3)
+        if not any(skipped["reason"] == "download" for skipped in manifest.get("skipped", [])):
+            return manifest
+    except ManifestNotFound:
+        pass
 
     images = []
-    for key in keys:
-        try:
-            # Get the object from S3
-            object = s3.get_object(Bucket=bucket_name, Key=key)
-        except Exception as e:
-            # If an error occurs during retrieval, print error message and continue to next key
-            print(f"Error getting object from S3: {key}. Error: {str(e)}")
-            continue
-        byte_array = object['Body'].read()
-        try:
-            # Open the image
-            image = Image.open(io.BytesIO(byte_array))
-            # Append the image to the `images` list
-            images.append(image)
-        except IOError as e:
-            # If an error occurs during reading of the image, print error message and continue to next key
-            print(f"Error reading image from S3 object: {key}. Error: {str(e)}")
+    sources = []
+    skipped = []
+    with profiling.stage("s3_download"):
+        for key, etag in listed:
+            try:
+                # Get the object from S3
+                object = s3.get_object(Bucket=bucket_name, Key=key)
+            except Exception as e:
+                # If an error occurs during retrieval, print error message and continue to next key
+                print(f"Error getting object from S3: {key}. Error: {str(e)}")
+                skipped.append({"key": key, "etag": etag, "reason": "download"})
+                continue
+            byte_array = object['Body'].read()
+            try:
+                # Open the image
+                image = Image.open(io.BytesIO(byte_array))
+                # Append the image to the `images` list, and its key and ETag to the `sources` list
+                images.append(image)
+                sources.append((key, object.get('ETag', etag)))
+            except IOError as e:
+                # If an error occurs during reading of the image, print error message and continue to next key
+                print(f"Error reading image from S3 object: {key}. Error: {str(e)}")
+                skipped.append({"key": key, "etag": etag, "reason": "decode"})
 
     if len(images) == 0:
         # If no valid images are found, raise an exception
         raise Exception("No valid images found in the S3 objects")
 
-    # Get the number of rows and columns in the grid
-    rows = grid_size[0]
-    cols = grid_size[1]
-
-    # Calculate the width of each cell in the grid
-    cell_width = int(sum(image.width for image in images) / cols)//2
-    # Calculate the height of each cell in the grid
-    cell_height = int(max(image.height for image in images) / rows)//2
-    # Get the aspect ratios of each image
-    aspect_ratios = [image.width/image.height for image in images]
-    # Get the max aspect ratio of all images
-    max_aspect_ratio = max(aspect_ratios)
-    # Update the cell height based on the max aspect ratio
-    cell_height = int(cell_width / max_aspect_ratio)
-    # Create a new image to store the results, with the calculated grid size
-    result = Image.new('RGB', (cell_width * cols, cell_height * rows))
-    
-    # Loop through the images and paste each one into the result image
-    for i, image in enumerate(images):
-        # Calculate the x and y position of the current image in the result image
-        x = int(i % cols) * cell_width
-        y = int(i / cols) * cell_height
-        # Resize the current image to the calculated cell size
-        resized_image = image.resize((cell_width, cell_height), Image.ANTIALIAS)
-        # Paste the resized image into the result image at the calculated position
-        result.paste(resized_image, (x, y))
-
-
-
-    # Save the merged image to S3 temporarily
-    temp_key = "temp/merged_image.png"
+    with profiling.stage("compose"):
+        # Get the number of rows and columns in the grid
+        rows = grid_size[0]
+        cols = grid_size[1]
+
+        # Calculate the width of each cell in the grid
+        cell_width = int(sum(image.width for image in images) / cols)//2
+        # Calculate the height of each cell in the grid
+        cell_height = int(max(image.height for image in images) / rows)//2
+        # Get the aspect ratios of each image
+        aspect_ratios = [image.width/image.height for image in images]
+        # Get the max aspect ratio of all images
+        max_aspect_ratio = max(aspect_ratios)
+        # Update the cell height based on the max aspect ratio
+        cell_height = int(cell_width / max_aspect_ratio)
+        # Create a new image to store the results, with the calculated grid size
+        result = Image.new('RGB', (cell_width * cols, cell_height * rows))
+
+        # Loop through the images and paste each one into the result image
+        for i, image in enumerate(images):
+            # Calculate the x and y position of the current image in the result image
+            x = int(i % cols) * cell_width
+            y = int(i / cols) * cell_height
+            # Resize the current image to the calculated cell size
+            resized_image = image.resize((cell_width, cell_height), Image.LANCZOS)
+            # Paste the resized image into the result image at the calculated position
+            result.paste(resized_image, (x, y))
+
+    manifest = {
+        "manifest_id": manifest_id,
+        "bucket": bucket_name,
+        "grid_key": grid_key(manifest_id),
+        "grid_size": [rows, cols],
+        # Images past the last cell fall outside the grid
+        "cells": [{"cell": i, "key": key, "etag": etag}
+                  for i, (key, etag) in enumerate(sources[:rows * cols])],
+        "skipped": skipped,
+    }
+
+    # Save the merged image to S3 under its content-addressed key
     result_bytes = io.BytesIO()
     try:
         # Save the result image to a binary stream
-        result.save(result_bytes, format='PNG', save_all=True)
+        with profiling.stage("encode"):
+            result.save(result_bytes, format='PNG', save_all=True)
     except Exception as e:
         print(f"Error saving merged image: {str(e)}")
         raise e
 
     result_bytes.seek(0)
     try:
-        # Upload the binary stream to S3
-        s3.put_object(Bucket=bucket_name, Key=temp_key, Body=result_bytes.getvalue(), ContentType='image/png')
+        # Upload the binary stream to S3, then the manifest, so that a manifest always points to a complete grid
+        with profiling.stage("s3_upload"):
+            s3.put_object(Bucket=bucket_name, Key=manifest["grid_key"], Body=result_bytes.getvalue(), ContentType='image/png')
+            s3.put_object(Bucket=bucket_name, Key=manifest_key(manifest_id), Body=json.dumps(manifest).encode("utf-8"),
+                          ContentType='application/json')
     except Exception as e:
-        print(f"Error putting merged image to S3: {temp_key}. Error: {str(e)}")
+        print(f"Error putting merged image to S3: {manifest['grid_key']}. Error: {str(e)}")
         raise e
 
-    return temp_key
-
-
+    _cache_manifest(manifest)
+    return manifest
@@ -5,10 +5,13 @@ import io
 import math
 from PIL import Image
 import random
+import profiling
+import rate_limiter
+from records import ModerationRecord
 
 
 
-def moderation(bucket, img_path):
+def moderation(bucket, img_path, grid_size=(4, 8)):
     # amazon rekognition connection
     boto3.setup_default_session(profile_name='default')
     client = boto3.client('rekognition')
@@ -17,18 +20,18 @@ def moderation(bucket, img_path):
     s3_connection = boto3.resource('s3')
 
     s3_object = s3_connection.Object(bucket,img_path)
-    s3_response = s3_object.get()
+    with profiling.stage("s3_download"):
+        s3_response = s3_object.get()
 
-    #read file directly from s3 bucket
-    stream = io.BytesIO(s3_response['Body'].read())
+        #read file directly from s3 bucket
+        stream = io.BytesIO(s3_response['Body'].read())
     img = Image.open(stream)
 
     #image dimensions
     imgWidth, imgHeight = img.size
 
 
-    gridCols = 8 #total columns in the grid
-    gridRows = 4 #total rows in thegrid
+    gridRows, gridCols = grid_size #total rows and columns in the grid
 
     userH = int(imgHeight / gridRows)  # user image height
     userW = int(imgWidth / gridCols)  # user image width
@@ -43,23 +46,25 @@ def moderation(bucket, img_path):
         toC = int(toCols * userW) #crop ending point for columns
         
         # Load the image into a NumPy array
-        np_image = np.array(image)
+        with profiling.stage("crop"):
+            np_image = np.array(image)
         
-        # Check if np_image has at least 2 dimensions
-        if np_image.ndim >= 2:
-            cropped_image = np_image[fromR:toR, fromC:toC] #halved image
-        else:
-            raise ValueError("np_image must have at least 2 dimensions, but it has {}".format(np_image.ndim))
+            # Check if np_image has at least 2 dimensions
+            if np_image.ndim >= 2:
+                cropped_image = np_image[fromR:toR, fromC:toC] #halved image
+            else:
+                raise ValueError("np_image must have at least 2 dimensions, but it has {}".format(np_image.ndim))
 
-        hashV = random.getrandbits(16) #unique id generated for each halved image
+            hashV = random.getrandbits(16) #unique id generated for each halved image
         
-        # Save the cropped image to a buffer
-        file_stream = io.BytesIO()
-        Image.fromarray(cropped_image).save(file_stream, format='PNG')
+            # Save the cropped image to a buffer
+            file_stream = io.BytesIO()
+            Image.fromarray(cropped_image).save(file_stream, format='PNG')
 
-        s3 = boto3.client("s3")
+        with profiling.stage("s3_upload"):
+            s3 = boto3.client("s3")
 
-        s3.put_object(Bucket=bucket, Key="temp/{}.png".format(hashV), Body=file_stream.getvalue())
+            s3.put_object(Bucket=bucket, Key="temp/{}.png".format(hashV), Body=file_stream.getvalue())
 
 
         return ("temp/{}.png".format(hashV))
@@ -86,8 +91,7 @@ def moderation(bucket, img_path):
 
         heightTotal = img.shape[0]  # total grid image height
         widthTotal = img.shape[1]  # total grid image width
-        cols = 8 #total grid image columns
-        rows = 4 #total grid image rows
+        rows, cols = grid_size #total grid image rows and columns
         personWidth = widthTotal / cols #user image width
         personHeight = heightTotal / rows #user image height
 
@@ -105,7 +109,8 @@ def moderation(bucket, img_path):
             method = eval(meth)
 
             # Apply template Matching
-            res = cv2.matchTemplate(img,template,method)
+            with profiling.stage("template_match"):
+                res = cv2.matchTemplate(img,template,method)
             min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res) #coordinates from the copied image
 
 
@@ -173,10 +178,7 @@ def moderation(bucket, img_path):
             gridPosArray = userPosition(cols, rows, image, img)
             gridPos = gridPosArray[0]['gridPosition']
 
-            results.append({
-                "GridPos": gridPos,
-                "Labels": response['ModerationLabels'],
-            })
+            results.append(ModerationRecord.from_api(gridPos, response['ModerationLabels']))
 
             try:
                 s3.head_object(Bucket=bucket, Key=naughtyImageFileName)
@@ -215,10 +217,12 @@ def moderation(bucket, img_path):
 
     # halved images (image1 and image2)
     # are processed through aws moderation API to check for any moderation labels         
-        response1 = client.detect_moderation_labels(Image={'S3Object': {'Bucket': bucket, 'Name': image1}})
+        response1 = rate_limiter.call('DetectModerationLabels', client.detect_moderation_labels,
+            Image={'S3Object': {'Bucket': bucket, 'Name': image1}})
 
 
-        response2 = client.detect_moderation_labels(Image={'S3Object': {'Bucket': bucket, 'Name': image2}})
+        response2 = rate_limiter.call('DetectModerationLabels', client.detect_moderation_labels,
+            Image={'S3Object': {'Bucket': bucket, 'Name': image2}})
 
             
     # if moderation label detected on the halved image, load the image, remove the image
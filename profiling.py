@@ -0,0 +1,197 @@
+"""
+On-demand profiling of single API requests.
+
+The handlers in api.py are wrapped with profiled(). When profiling is switched off (the
+default) profiled() returns the handler unchanged, so a deployment pays nothing for it.
+It is switched on with environment variables:
+
+- PROFILE_SAMPLE_RATE: share of requests profiled at random (default 0)
+- PROFILE_ALLOW_HEADER: set to 1 to profile the requests sent with the X-Profile-Request header
+  (value 1 or cprofile for cProfile stats, collapsed for a flame graph)
+- PROFILE_FORMAT: format of the sampled requests, cprofile (default) or collapsed
+- PROFILE_DIR: directory the profiles are written to (default profiles)
+- PROFILE_INTERVAL: seconds between two stack samples in the collapsed format (default 0.005)
+
+Each profiled request writes <id>.prof (cProfile stats, open with pstats or snakeviz) or
+<id>.collapsed (one "frame;frame;frame count" line per stack, for flamegraph.pl or speedscope),
+next to <id>.json with the endpoint, the request parameters, the status, the wall time and the
+time spent in each stage. The id is returned in the X-Profile-Id response header.
+From Python 3.12 only one cProfile profiler can be active at a time: a request picked while
+another one is being profiled with cProfile runs unprofiled, without the header.
+
+Stages are marked in the code with `with profiling.stage("name"):`. Outside a profiled request
+stage() returns a shared no-op context manager.
+"""
+
+# profiling.py
+import collections
+import contextlib
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+from flask import make_response, request
+
+SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+ALLOW_HEADER = os.environ.get("PROFILE_ALLOW_HEADER", "0") == "1"
+DEFAULT_FORMAT = os.environ.get("PROFILE_FORMAT", "cprofile")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))
+HEADER = "X-Profile-Request"
+FORMATS = ("cprofile", "collapsed")
+
+ENABLED = SAMPLE_RATE > 0 or ALLOW_HEADER
+
+_stages = contextvars.ContextVar("profile_stages", default=None)
+_no_stage = contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def _timed_stage(stages, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] += time.perf_counter() - start
+
+
+def stage(name):
+    # Time the block as a stage of the profiled request, if there is one
+    stages = _stages.get()
+    if stages is None:
+        return _no_stage
+    return _timed_stage(stages, name)
+
+
+def record_stage(name, seconds):
+    # Add a duration measured elsewhere to a stage of the profiled request
+    stages = _stages.get()
+    if stages is not None:
+        stages[name] += seconds
+
+
+class _StackSampler:
+    # Samples the stack of one thread at a fixed interval and counts the collapsed stacks
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _requested_format():
+    # Format to profile the current request with, or None to leave it alone
+    if ALLOW_HEADER and HEADER in request.headers:
+        value = request.headers[HEADER].strip().lower()
+        if value in ("1", "true"):
+            return "cprofile"
+        if value in FORMATS:
+            return value
+    if SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE:
+        return DEFAULT_FORMAT
+    return None
+
+
+def _request_parameters():
+    parameters = dict(request.args)
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        parameters.update(body)
+    return parameters
+
+
+def profiled(view):
+    # Wrap a Flask handler so that the requests picked for profiling are profiled
+    if not ENABLED:
+        return view
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        profile_format = _requested_format()
+        if profile_format is None:
+            return view(*args, **kwargs)
+
+        endpoint = request.path.strip("/").replace("/", "_") or "root"
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}_{re.sub(r'[^A-Za-z0-9_-]', '', endpoint)}_{uuid.uuid4().hex[:8]}"
+        stages = collections.defaultdict(float)
+        token = _stages.set(stages)
+        if profile_format == "collapsed":
+            profiler = _StackSampler(threading.get_ident(), INTERVAL)
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already active (only one at a time from Python 3.12): serve the request unprofiled
+                _stages.reset(token)
+                return view(*args, **kwargs)
+
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = make_response(view(*args, **kwargs))
+            status = response.status_code
+        finally:
+            wall_time = time.perf_counter() - start
+            if profile_format == "collapsed":
+                profiler.stop()
+            else:
+                profiler.disable()
+            _stages.reset(token)
+
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, profile_id)
+            if profile_format == "collapsed":
+                profiler.dump(path + ".collapsed")
+            else:
+                profiler.dump_stats(path + ".prof")
+            with open(path + ".json", "w") as f:
+                json.dump({
+                    "id": profile_id,
+                    "endpoint": request.path,
+                    "method": request.method,
+                    "parameters": _request_parameters(),
+                    "format": profile_format,
+                    "status": status,
+                    "wall_time": wall_time,
+                    "stages": dict(stages),
+                }, f, indent=2, default=str)
+
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+
+    return wrapper
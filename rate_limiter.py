@@ -0,0 +1,263 @@
+"""
+Shared rate limiter for the Amazon Rekognition calls made by the API.
+
+Rekognition limits the number of transactions per second per account and per operation.
+Face detection, the moderation recursion and custom labels all go through call(), which
+takes a token from a bucket dedicated to that operation before hitting Rekognition.
+
+The bucket state lives in a small JSON file guarded by an exclusive file lock, so every
+thread and every worker process on the node draws from the same budget.
+
+When Rekognition answers with a throttling error the bucket halves its refill rate (at most
+once per DECREASE_WINDOW, so the calls throttled by one burst count once) and drains, then recovers additively back towards the configured rate (AIMD), so the node
+settles just under the real account limit instead of failing requests.
+
+Interactive requests (the default) may use the whole bucket. Batch work, marked with
+`with rate_limiter.priority(rate_limiter.BATCH):`, must leave a reserve of tokens untouched
+so that interactive requests are served first.
+
+The time every call spent waiting for a token is recorded and reported by stats().
+"""
+
+# rate_limiter.py
+import contextlib
+import contextvars
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import profiling
+
+try:
+    import fcntl
+except ImportError:
+    # No file locks on this platform: the bucket is shared by the threads of one process only
+    fcntl = None
+
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# Default transactions per second for each Rekognition operation, overridable per operation
+# with the REKOGNITION_TPS_<OPERATION> environment variable (e.g. REKOGNITION_TPS_DETECTFACES)
+DEFAULT_TPS = {
+    "DetectFaces": 50.0,
+    "DetectModerationLabels": 50.0,
+    "DetectCustomLabels": 5.0,
+}
+FALLBACK_TPS = 5.0
+
+# Error codes Rekognition uses when the account is over its limit
+THROTTLING_CODES = {
+    "ThrottlingException",
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+}
+
+# Share of the bucket that batch work may not touch
+BATCH_RESERVE = 0.2
+# Factor applied to the refill rate on a throttling error
+THROTTLE_DECREASE = 0.5
+# Throttling errors within this many seconds of a decrease belong to the same burst and do not decrease the rate again
+DECREASE_WINDOW = 1.0
+# Lowest refill rate, as a share of the configured rate
+MIN_RATE_SHARE = 0.05
+# Share of the configured rate recovered per second after a throttling error
+RECOVERY_PER_SECOND = 0.05
+# Retries of a throttled call before giving up
+MAX_ATTEMPTS = 5
+# Base and cap of the exponential backoff between retries, in seconds
+BACKOFF_BASE = 0.1
+BACKOFF_CAP = 5.0
+# Longest single sleep while waiting for a token, so rate changes are picked up quickly
+MAX_SLEEP = 0.25
+
+STATE_DIR = os.environ.get(
+    "REKOGNITION_LIMITER_DIR", os.path.join(tempfile.gettempdir(), "rekognition_limiter"))
+
+
+class RekognitionThrottled(Exception):
+    # Raised when Rekognition keeps throttling a call after every retry
+    def __init__(self, operation, retry_after):
+        super().__init__(f"Rekognition {operation} is throttled, retry after {retry_after:.1f}s")
+        self.operation = operation
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Rebuilt from its own arguments when copied or pickled
+        return self.__class__, (self.operation, self.retry_after)
+
+
+_priority = contextvars.ContextVar("rekognition_priority", default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(level):
+    # Run the Rekognition calls made inside the block with the given priority
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, operation, rate):
+        if rate <= 0:
+            raise ValueError(f"Rekognition {operation} rate must be positive, got {rate}")
+        self.operation = operation
+        self.max_rate = rate
+        self.min_rate = rate * MIN_RATE_SHARE
+        self.reserve = max(rate, 1.0) * BATCH_RESERVE
+        # Allow a burst of one second worth of calls, and always room for one batch call above the reserve
+        self.capacity = max(rate, 1.0 + self.reserve)
+        self._lock = threading.Lock()
+        self._memory_state = None
+        self._path = os.path.join(STATE_DIR, f"{operation}.json")
+
+    def _initial_state(self):
+        return {"tokens": self.capacity, "rate": self.max_rate, "updated": time.time()}
+
+    @contextlib.contextmanager
+    def _state(self):
+        # Read, modify and write back the bucket state under the thread and file locks
+        with self._lock:
+            if fcntl is None:
+                if self._memory_state is None:
+                    self._memory_state = self._initial_state()
+                yield self._memory_state
+                return
+
+            os.makedirs(STATE_DIR, exist_ok=True)
+            with open(self._path, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:
+                        state = self._initial_state()
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state["updated"])
+        # Additive recovery of the refill rate towards the configured rate
+        state["rate"] = min(self.max_rate, state["rate"] + self.max_rate * RECOVERY_PER_SECOND * elapsed)
+        state["tokens"] = min(self.capacity, state["tokens"] + elapsed * state["rate"])
+        state["updated"] = now
+
+    def try_take(self, level):
+        # Take one token and return 0, or return how long to wait before trying again
+        floor = self.reserve if level == BATCH else 0.0
+        with self._state() as state:
+            self._refill(state, time.time())
+            if state["tokens"] - 1.0 >= floor:
+                state["tokens"] -= 1.0
+                return 0.0
+            return (1.0 + floor - state["tokens"]) / state["rate"]
+
+    def throttled(self):
+        # Multiplicative decrease of the refill rate, once per burst of throttling errors, and drain the bucket
+        now = time.time()
+        with self._state() as state:
+            self._refill(state, now)
+            if now - state.get("decreased", 0.0) >= DECREASE_WINDOW:
+                state["rate"] = max(self.min_rate, state["rate"] * THROTTLE_DECREASE)
+                state["decreased"] = now
+            state["tokens"] = 0.0
+            return 1.0 / state["rate"]
+
+    def current_rate(self):
+        with self._state() as state:
+            self._refill(state, time.time())
+            return state["rate"]
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _bucket(operation):
+    with _buckets_lock:
+        if operation not in _buckets:
+            rate = float(os.environ.get(
+                f"REKOGNITION_TPS_{operation.upper()}", DEFAULT_TPS.get(operation, FALLBACK_TPS)))
+            _buckets[operation] = TokenBucket(operation, rate)
+        return _buckets[operation]
+
+
+def _record(operation, level, wait=None, throttled=False):
+    with _stats_lock:
+        entry = _stats.setdefault(operation, {})
+        level_stats = entry.setdefault(level, {
+            "calls": 0, "throttled": 0, "wait_total": 0.0, "wait_max": 0.0, "wait_last": 0.0})
+        if wait is not None:
+            level_stats["calls"] += 1
+            level_stats["wait_total"] += wait
+            level_stats["wait_max"] = max(level_stats["wait_max"], wait)
+            level_stats["wait_last"] = wait
+        if throttled:
+            level_stats["throttled"] += 1
+
+
+def acquire(operation):
+    # Block until a token is available for the operation and return the queueing delay
+    level = _priority.get()
+    bucket = _bucket(operation)
+    start = time.monotonic()
+    while True:
+        wait = bucket.try_take(level)
+        if wait <= 0:
+            break
+        time.sleep(min(wait, MAX_SLEEP))
+    delay = time.monotonic() - start
+    _record(operation, level, wait=delay)
+    return delay
+
+
+def call(operation, function, **kwargs):
+    # Call a Rekognition client method within the operation budget,
+    # retrying with backoff while Rekognition throttles the account
+    bucket = _bucket(operation)
+    retry_after = 0.0
+    for attempt in range(MAX_ATTEMPTS):
+        profiling.record_stage("rekognition_queue", acquire(operation))
+        try:
+            with profiling.stage(f"rekognition:{operation}"):
+                return function(**kwargs)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in THROTTLING_CODES:
+                raise e
+            _record(operation, _priority.get(), throttled=True)
+            retry_after = bucket.throttled()
+            # Full jitter so the workers do not retry in lockstep
+            time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+    raise RekognitionThrottled(operation, retry_after)
+
+
+def stats():
+    # Queueing delay and throttling counters of this process for each priority, with the current refill rate of each bucket
+    with _stats_lock:
+        levels = {operation: {level: dict(values) for level, values in operation_levels.items()}
+                  for operation, operation_levels in _stats.items()}
+    report = {}
+    for operation, operation_levels in levels.items():
+        for values in operation_levels.values():
+            values["wait_avg"] = values["wait_total"] / values["calls"] if values["calls"] else 0.0
+        bucket = _bucket(operation)
+        report[operation] = {"levels": operation_levels, "rate": bucket.current_rate(), "max_rate": bucket.max_rate}
+    return report
@@ -0,0 +1,222 @@
+"""
+Compact result records returned by the detection functions, and a fast path to serialise them.
+
+FaceRecord, ModerationRecord and CustomLabelRecord replace the per-result dicts built by
+detect_faces, moderation and display_image. They use __slots__, so a record costs a fraction
+of the memory of the equivalent dict, and each one writes its own JSON with a string template
+instead of going through the generic encoder.
+
+FaceBatch keeps the faces of many grids as parallel arrays (struct of arrays), for batch output
+across thousands of grids.
+
+The JSON produced by dumps() has exactly the same shape as the dicts the API used to return
+(to_dict() still builds those dicts), so callers of the endpoints see no difference. Results
+found in a grid with a manifest (see mergeGrid.py) also carry the user_key of their cell.
+"""
+
+# records.py
+from array import array
+from json.encoder import encode_basestring_ascii as _string
+
+from flask import Response
+
+
+# %r gives the same representation as the json module for ints and finite floats
+_FACE_TEMPLATE = '{"grid_position":%d,"age_range":[%d,%d],"Highest Confidence Emotion":{"Confidence":%r,"Type":%s}}'
+
+
+def _with_user_key(json, user_key):
+    # Append the user_key member to a JSON object, when the result was mapped to a user
+    if user_key is None:
+        return json
+    return '%s,"user_key":%s}' % (json[:-1], _string(user_key))
+
+
+def _number(value):
+    # Same representation as the json module for ints and floats
+    if isinstance(value, float):
+        return float.__repr__(value)
+    return int.__repr__(value)
+
+
+class FaceRecord:
+    __slots__ = ("grid_position", "age_low", "age_high", "emotion_confidence", "emotion_type", "user_key")
+
+    def __init__(self, grid_position, age_low, age_high, emotion_confidence, emotion_type, user_key=None):
+        self.grid_position = grid_position
+        self.age_low = age_low
+        self.age_high = age_high
+        self.emotion_confidence = emotion_confidence
+        self.emotion_type = emotion_type
+        self.user_key = user_key
+
+    @property
+    def cell(self):
+        return self.grid_position
+
+    def to_dict(self):
+        face = {
+            'grid_position': self.grid_position,
+            'age_range': (self.age_low, self.age_high),
+            'Highest Confidence Emotion': {
+                'Confidence': self.emotion_confidence,
+                'Type': self.emotion_type
+            }
+        }
+        if self.user_key is not None:
+            face['user_key'] = self.user_key
+        return face
+
+    def to_json(self):
+        json = _FACE_TEMPLATE % (self.grid_position, self.age_low, self.age_high,
+                                 self.emotion_confidence, _string(self.emotion_type))
+        return _with_user_key(json, self.user_key)
+
+
+class ModerationLabel:
+    __slots__ = ("confidence", "name", "parent_name", "taxonomy_level")
+
+    def __init__(self, confidence, name, parent_name=None, taxonomy_level=None):
+        self.confidence = confidence
+        self.name = name
+        self.parent_name = parent_name
+        self.taxonomy_level = taxonomy_level
+
+    @classmethod
+    def from_api(cls, label):
+        # Build a label from an entry of the ModerationLabels list returned by Rekognition
+        return cls(label['Confidence'], label['Name'], label.get('ParentName'), label.get('TaxonomyLevel'))
+
+    def to_dict(self):
+        label = {'Confidence': self.confidence, 'Name': self.name}
+        if self.parent_name is not None:
+            label['ParentName'] = self.parent_name
+        if self.taxonomy_level is not None:
+            label['TaxonomyLevel'] = self.taxonomy_level
+        return label
+
+    def to_json(self):
+        if self.taxonomy_level is None:
+            if self.parent_name is None:
+                return '{"Confidence":%r,"Name":%s}' % (self.confidence, _string(self.name))
+            return '{"Confidence":%r,"Name":%s,"ParentName":%s}' % (
+                self.confidence, _string(self.name), _string(self.parent_name))
+        json = '{"Confidence":%r,"Name":%s' % (self.confidence, _string(self.name))
+        if self.parent_name is not None:
+            json += ',"ParentName":%s' % _string(self.parent_name)
+        return json + ',"TaxonomyLevel":%d}' % self.taxonomy_level
+
+
+class ModerationRecord:
+    __slots__ = ("grid_pos", "labels", "user_key")
+
+    def __init__(self, grid_pos, labels, user_key=None):
+        self.grid_pos = grid_pos
+        self.labels = labels
+        self.user_key = user_key
+
+    @property
+    def cell(self):
+        return self.grid_pos
+
+    @classmethod
+    def from_api(cls, grid_pos, moderation_labels):
+        return cls(grid_pos, tuple([ModerationLabel.from_api(label) for label in moderation_labels]))
+
+    def to_dict(self):
+        result = {"GridPos": self.grid_pos, "Labels": [label.to_dict() for label in self.labels]}
+        if self.user_key is not None:
+            result["user_key"] = self.user_key
+        return result
+
+    def to_json(self):
+        json = '{"GridPos":%d,"Labels":[%s]}' % (self.grid_pos, ','.join([label.to_json() for label in self.labels]))
+        return _with_user_key(json, self.user_key)
+
+
+class CustomLabelRecord:
+    __slots__ = ("grid_pos", "label", "user_key")
+
+    def __init__(self, grid_pos, label, user_key=None):
+        self.grid_pos = grid_pos
+        self.label = label
+        self.user_key = user_key
+
+    @property
+    def cell(self):
+        return self.grid_pos
+
+    def to_dict(self):
+        result = {"gridPos": self.grid_pos, "label": self.label}
+        if self.user_key is not None:
+            result["user_key"] = self.user_key
+        return result
+
+    def to_json(self):
+        return _with_user_key('{"gridPos":%d,"label":%s}' % (self.grid_pos, _string(self.label)), self.user_key)
+
+
+class FaceBatch:
+    # Faces of many grids stored column by column, one array per field
+
+    def __init__(self):
+        # grid id -> (start, end) offsets of its faces in the arrays, in the order the grids were added
+        self.grids = {}
+        self.grid_positions = array('i')
+        self.age_lows = array('i')
+        self.age_highs = array('i')
+        self.emotion_confidences = array('d')
+        self.emotion_types = []
+        self.user_keys = []
+
+    def __len__(self):
+        return len(self.grid_positions)
+
+    def extend(self, grid_id, face_records):
+        # Append the faces detected in one grid; a grid may be extended several times, or with no faces
+        start = len(self.grid_positions)
+        self.grids.setdefault(grid_id, []).append((start, start + len(face_records)))
+        self.grid_positions.extend([face.grid_position for face in face_records])
+        self.age_lows.extend([face.age_low for face in face_records])
+        self.age_highs.extend([face.age_high for face in face_records])
+        self.emotion_confidences.extend([face.emotion_confidence for face in face_records])
+        self.emotion_types.extend([face.emotion_type for face in face_records])
+        self.user_keys.extend([face.user_key for face in face_records])
+
+    def records(self, grid_id):
+        # Rebuild the face records of one grid
+        return [FaceRecord(self.grid_positions[i], self.age_lows[i], self.age_highs[i],
+                           self.emotion_confidences[i], self.emotion_types[i], self.user_keys[i])
+                for start, end in self.grids.get(grid_id, ()) for i in range(start, end)]
+
+    def to_json(self):
+        # Same shape as a JSON object mapping each grid id to its list of faces
+        faces = [_with_user_key(_FACE_TEMPLATE % (position, low, high, confidence, _string(emotion)), user_key)
+                 for position, low, high, confidence, emotion, user_key in zip(
+                     self.grid_positions, self.age_lows, self.age_highs,
+                     self.emotion_confidences, self.emotion_types, self.user_keys)]
+        return '{%s}' % ','.join([
+            '%s:[%s]' % (_string(str(grid_id)), ','.join([face for start, end in ranges for face in faces[start:end]]))
+            for grid_id, ranges in self.grids.items()])
+
+
+def dumps(value):
+    # Serialise records, lists of records and dicts of those to JSON
+    if hasattr(value, 'to_json'):
+        return value.to_json()
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join([dumps(item) for item in value])
+    if isinstance(value, dict):
+        return '{%s}' % ','.join(['%s:%s' % (_string(key), dumps(item)) for key, item in value.items()])
+    if isinstance(value, str):
+        return _string(value)
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return _number(value)
+
+
+def json_response(value, status=200):
+    # Flask response built with the fast serialisation path instead of jsonify
+    return Response(dumps(value), status=status, mimetype='application/json')
@@ -0,0 +1,6 @@
+# tests/conftest.py
+import os
+import sys
+
+# The modules of the API live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,152 @@
+# tests/test_coalesce.py
+import threading
+import time
+
+import pytest
+
+import coalesce
+import rate_limiter
+
+
+class CountingEvent(threading.Event):
+    # Event that counts the callers waiting on it
+    def __init__(self):
+        super().__init__()
+        self.waiting = 0
+        self._count_lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        with self._count_lock:
+            self.waiting += 1
+        return super().wait(timeout)
+
+
+@pytest.fixture
+def events(monkeypatch):
+    # The events of the calls made by SingleFlight, which count their waiting callers
+    created = []
+
+    class CountingCall(coalesce._Call):
+        def __init__(self):
+            super().__init__()
+            self.done = CountingEvent()
+            created.append(self.done)
+
+    monkeypatch.setattr(coalesce, "_Call", CountingCall)
+    return created
+
+
+def run_concurrently(flight, key, function, callers, events):
+    # Run the callers until all but the first one wait on the call in flight, then let the call finish
+    outcomes = [None] * callers
+    release = threading.Event()
+
+    def caller(i):
+        try:
+            outcomes[i] = flight.do(key, lambda: function(release))
+        except Exception as e:
+            outcomes[i] = e
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(callers)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and not (events and events[0].waiting == callers - 1):
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def test_concurrent_callers_join_the_call_in_flight(events):
+    flight = coalesce.SingleFlight(result_ttl=0)
+    calls = []
+
+    def analyse(release):
+        calls.append(1)
+        release.wait(5)
+        return {"faces": []}
+
+    outcomes = run_concurrently(flight, "key", analyse, 5, events)
+    assert len(calls) == 1
+    assert all(outcome is outcomes[0] for outcome in outcomes)
+
+
+def test_different_keys_are_not_coalesced():
+    flight = coalesce.SingleFlight(result_ttl=0)
+    assert flight.do("a", lambda: 1) == 1
+    assert flight.do("b", lambda: 2) == 2
+
+
+def test_result_is_reused_within_the_window(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(coalesce.time, "monotonic", lambda: now[0])
+    flight = coalesce.SingleFlight(result_ttl=1.0)
+    calls = []
+
+    def analyse():
+        calls.append(1)
+        return len(calls)
+
+    assert flight.do("key", analyse) == 1
+    now[0] += 0.5
+    assert flight.do("key", analyse) == 1
+    now[0] += 0.6
+    assert flight.do("key", analyse) == 2
+    assert len(calls) == 2
+
+
+def test_no_window_without_ttl():
+    flight = coalesce.SingleFlight(result_ttl=0)
+    calls = []
+    flight.do("key", lambda: calls.append(1))
+    flight.do("key", lambda: calls.append(1))
+    assert len(calls) == 2
+
+
+def test_error_is_shared_with_the_waiters_as_a_fresh_exception(events):
+    flight = coalesce.SingleFlight(result_ttl=1.0)
+    error = rate_limiter.RekognitionThrottled("DetectFaces", 2.0)
+
+    def analyse(release):
+        release.wait(5)
+        raise error
+
+    outcomes = run_concurrently(flight, "key", analyse, 4, events)
+
+    assert sum(outcome is error for outcome in outcomes) == 1
+    copies = [outcome for outcome in outcomes if outcome is not error]
+    assert len(copies) == 3
+    assert len({id(outcome) for outcome in copies}) == 3
+    for outcome in copies:
+        assert type(outcome) is rate_limiter.RekognitionThrottled
+        assert outcome.retry_after == 2.0
+        assert outcome.__cause__ is error
+
+
+def test_errors_are_not_kept_in_the_window():
+    flight = coalesce.SingleFlight(result_ttl=10.0)
+
+    def fail():
+        raise ValueError("no grid")
+
+    with pytest.raises(ValueError):
+        flight.do("key", fail)
+    assert flight.do("key", lambda: "grid") == "grid"
+
+
+def test_error_that_cannot_be_copied_is_wrapped():
+    class Unbuildable(Exception):
+        def __init__(self, code, message):
+            super().__init__(message)
+
+    error = Unbuildable(1, "failed")
+    shared = coalesce._waiter_error(error)
+    assert isinstance(shared, coalesce.CoalescedError)
+
+
+def test_request_key_accepts_unhashable_values():
+    key = coalesce.request_key("detect_faces", bucket_name=["a"], prefix={"b": 1}, manifest_id=None)
+    assert hash(key) == hash(coalesce.request_key("detect_faces", manifest_id=None, prefix={"b": 1}, bucket_name=["a"]))
+    assert key != coalesce.request_key("moderation", bucket_name=["a"], prefix={"b": 1}, manifest_id=None)
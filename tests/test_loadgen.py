@@ -0,0 +1,24 @@
+# tests/test_loadgen.py
+import pytest
+from botocore.exceptions import ClientError
+
+import loadgen
+from fake_aws import FakeAWS
+
+
+def test_throttled_call_is_counted_once_under_rekognition():
+    aws = FakeAWS(throttle_rate=1.0)
+    aws.seed_grid("bucket", "grid.png")
+    with aws.installed(), aws.track() as calls:
+        with pytest.raises(ClientError):
+            aws.client("rekognition").detect_faces(Image={"S3Object": {"Bucket": "bucket", "Name": "grid.png"}})
+    assert calls == {("rekognition", "DetectFaces"): 1, ("rekognition_throttled", "DetectFaces"): 1}
+
+
+def test_rekognition_total_leaves_throttles_out():
+    calls = {("s3", "GetObject"): 4, ("rekognition", "DetectModerationLabels"): 3,
+             ("rekognition_throttled", "DetectModerationLabels"): 2}
+    results = [{"endpoint": "/moderation", "latency": 0.5, "calls": calls, "error": None}]
+    report = loadgen.summarise(results, 1.0)["endpoints"]["/moderation"]["calls_per_request"]
+    assert report["rekognition"] == 3
+    assert report["rekognition_throttled"] == 2
@@ -0,0 +1,141 @@
+# tests/test_merge_grid.py
+import pytest
+
+import api
+import coalesce
+import fake_aws
+import mergeGrid
+import rate_limiter
+from fake_aws import FakeAWS
+
+
+@pytest.fixture
+def aws(monkeypatch, tmp_path):
+    # A fresh bucket of 32 users, with no manifest cached and no coalesced result from another test
+    monkeypatch.setattr(mergeGrid, "_manifests", type(mergeGrid._manifests)())
+    monkeypatch.setattr(api, "analyses", coalesce.SingleFlight(result_ttl=0))
+    monkeypatch.setattr(rate_limiter, "STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(rate_limiter, "_buckets", {})
+    aws = FakeAWS()
+    aws.seed_prefix("bucket", "users/", flag_cells=(5, 17))
+    with aws.installed():
+        yield aws
+
+
+@pytest.fixture
+def client(aws):
+    return api.app.test_client()
+
+
+def merge(aws, client, grid_size=(4, 8)):
+    # Merge the users and return the manifest with the S3 calls the merge made
+    with aws.track() as calls:
+        response = client.post("/merge-images", json={
+            "bucket_name": "bucket", "prefix": "users/", "grid_size": list(grid_size)})
+    assert response.status_code == 200
+    return response.json, dict(calls)
+
+
+def test_merging_again_reuses_the_grid(aws, client):
+    first, calls = merge(aws, client)
+    assert calls[("s3", "GetObject")] == 33  # The missing manifest and the 32 users
+    assert len(first["cells"]) == 32
+    assert first["cells"][5] == {"cell": 5, "key": "users/user-005.png", "etag": aws.bucket("bucket")["users/user-005.png"][1]}
+    assert first["grid_key"] in aws.bucket("bucket")
+
+    second, calls = merge(aws, client)
+    assert second["manifest_id"] == first["manifest_id"]
+    assert calls[("s3", "ListObjects")] == 1
+    assert ("s3", "GetObject") not in calls
+    assert ("s3", "PutObject") not in calls
+
+
+def test_grid_size_and_etags_change_the_manifest_id(aws, client):
+    first, _ = merge(aws, client)
+    other_layout, _ = merge(aws, client, grid_size=(2, 16))
+    assert other_layout["manifest_id"] != first["manifest_id"]
+
+    aws.write("bucket", "users/user-000.png", aws.bucket("bucket")["users/user-001.png"][0])
+    changed, calls = merge(aws, client)
+    assert changed["manifest_id"] != first["manifest_id"]
+    assert calls[("s3", "GetObject")] == 33
+
+
+def test_folder_marker_and_non_image_objects_keep_the_grid_reusable(aws, client):
+    aws.write("bucket", "users/", b"")
+    aws.write("bucket", "users/notes.txt", b"not an image")
+    first, _ = merge(aws, client)
+    assert len(first["cells"]) == 32
+    assert first["skipped"] == [
+        {"key": "users/notes.txt", "etag": aws.bucket("bucket")["users/notes.txt"][1], "reason": "decode"}]
+
+    second, calls = merge(aws, client)
+    assert second["manifest_id"] == first["manifest_id"]
+    assert ("s3", "GetObject") not in calls
+
+
+def test_failed_download_forces_a_rebuild(aws, client, monkeypatch):
+    get_object = fake_aws.FakeS3.get_object
+
+    def failing_get_object(self, Bucket, Key, **kwargs):
+        if Key == "users/user-003.png":
+            raise fake_aws._client_error("InternalError", "Try again", "GetObject")
+        return get_object(self, Bucket, Key, **kwargs)
+
+    monkeypatch.setattr(fake_aws.FakeS3, "get_object", failing_get_object)
+    first, _ = merge(aws, client)
+    assert len(first["cells"]) == 31
+    assert [skipped["reason"] for skipped in first["skipped"]] == ["download"]
+
+    monkeypatch.setattr(fake_aws.FakeS3, "get_object", get_object)
+    second, calls = merge(aws, client)
+    assert second["manifest_id"] == first["manifest_id"]
+    assert calls[("s3", "GetObject")] == 32
+    assert len(second["cells"]) == 32
+    assert second["skipped"] == []
+
+
+def test_expired_grid_is_rebuilt_and_its_manifest_id_not_found(aws, client):
+    first, _ = merge(aws, client)
+    for key in [key for key in aws.bucket("bucket") if key.startswith(mergeGrid.GRID_PREFIX)]:
+        del aws.bucket("bucket")[key]
+
+    response = client.post("/detect_faces", json={"bucket_name": "bucket", "manifest_id": first["manifest_id"]})
+    assert response.status_code == 404
+
+    second, calls = merge(aws, client)
+    assert second["manifest_id"] == first["manifest_id"]
+    assert calls[("s3", "PutObject")] == 2
+    assert second["grid_key"] in aws.bucket("bucket")
+    response = client.post("/detect_faces", json={"bucket_name": "bucket", "prefix": "users/"})
+    assert response.status_code == 200
+
+
+def test_detect_faces_with_a_manifest_sets_the_user_keys(aws, client):
+    manifest, _ = merge(aws, client)
+    response = client.post("/detect_faces", json={"bucket_name": "bucket", "manifest_id": manifest["manifest_id"]})
+    assert response.status_code == 200
+    faces = response.json
+    assert len(faces) == 32
+    assert all(face["user_key"] == f"users/user-{face['grid_position']:03d}.png" for face in faces)
+
+
+@pytest.mark.parametrize("grid_size", [(4, 8), (2, 16)])
+def test_moderation_hits_are_mapped_to_the_users_of_the_manifest(aws, client, grid_size):
+    manifest, _ = merge(aws, client, grid_size)
+    assert manifest["grid_size"] == list(grid_size)
+    response = client.post("/moderation", json={"bucket": "bucket", "manifest_id": manifest["manifest_id"]})
+    assert response.status_code == 200
+    assert sorted((result["GridPos"], result["user_key"]) for result in response.json) == [
+        (5, "users/user-005.png"), (17, "users/user-017.png")]
+
+
+@pytest.mark.parametrize("manifest_id", ["not-a-manifest", "0" * 64])
+@pytest.mark.parametrize("endpoint, payload", [
+    ("/detect_faces", {"bucket_name": "bucket"}),
+    ("/moderation", {"bucket": "bucket"}),
+    ("/detect_custom_labels", {"bucket": "bucket", "model": "arn:model"}),
+])
+def test_unknown_or_invalid_manifest_id_is_not_found(client, endpoint, payload, manifest_id):
+    response = client.post(endpoint, json=dict(payload, manifest_id=manifest_id))
+    assert response.status_code == 404
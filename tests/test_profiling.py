@@ -0,0 +1,85 @@
+# tests/test_profiling.py
+import json
+import time
+
+import pytest
+from flask import Flask, jsonify, request
+
+import profiling
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, "ENABLED", True)
+    monkeypatch.setattr(profiling, "ALLOW_HEADER", True)
+    monkeypatch.setattr(profiling, "SAMPLE_RATE", 0.0)
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+
+    app = Flask(__name__)
+
+    @app.route("/detect_faces", methods=["POST"])
+    @profiling.profiled
+    def detect_faces():
+        with profiling.stage("compose"):
+            time.sleep(0.01)
+        profiling.record_stage("rekognition_queue", 0.5)
+        return jsonify({"prefix": request.json["prefix"]})
+
+    return app.test_client()
+
+
+def test_profiled_request_writes_stats_and_metadata(client, tmp_path):
+    response = client.post("/detect_faces", json={"prefix": "users/"}, headers={profiling.HEADER: "1"})
+    assert response.status_code == 200
+    assert response.json == {"prefix": "users/"}
+    profile_id = response.headers["X-Profile-Id"]
+    assert (tmp_path / f"{profile_id}.prof").exists()
+
+    metadata = json.loads((tmp_path / f"{profile_id}.json").read_text())
+    assert metadata["id"] == profile_id
+    assert metadata["endpoint"] == "/detect_faces"
+    assert metadata["method"] == "POST"
+    assert metadata["parameters"] == {"prefix": "users/"}
+    assert metadata["format"] == "cprofile"
+    assert metadata["status"] == 200
+    assert metadata["stages"]["compose"] >= 0.01
+    assert metadata["stages"]["rekognition_queue"] == 0.5
+    assert metadata["wall_time"] >= metadata["stages"]["compose"]
+
+
+def test_collapsed_format_writes_stacks(client, tmp_path):
+    response = client.post("/detect_faces", json={"prefix": "users/"}, headers={profiling.HEADER: "collapsed"})
+    profile_id = response.headers["X-Profile-Id"]
+    assert (tmp_path / f"{profile_id}.collapsed").exists()
+    assert json.loads((tmp_path / f"{profile_id}.json").read_text())["format"] == "collapsed"
+
+
+def test_request_without_header_is_not_profiled(client, tmp_path):
+    response = client.post("/detect_faces", json={"prefix": "users/"})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+    assert list(tmp_path.iterdir()) == []
+    # Stages outside a profiled request are no-ops
+    assert profiling.stage("compose") is profiling._no_stage
+
+
+def test_request_is_served_unprofiled_when_another_profiler_is_active(client, tmp_path, monkeypatch):
+    def enable(self):
+        raise ValueError("Another profiling tool is already active")
+
+    monkeypatch.setattr(profiling.cProfile.Profile, "enable", enable)
+    response = client.post("/detect_faces", json={"prefix": "users/"}, headers={profiling.HEADER: "1"})
+    assert response.status_code == 200
+    assert response.json == {"prefix": "users/"}
+    assert "X-Profile-Id" not in response.headers
+    assert list(tmp_path.iterdir()) == []
+    assert profiling._stages.get() is None
+
+
+def test_view_is_left_unwrapped_when_profiling_is_off(monkeypatch):
+    monkeypatch.setattr(profiling, "ENABLED", False)
+
+    def view():
+        return "ok"
+
+    assert profiling.profiled(view) is view
@@ -0,0 +1,161 @@
+# tests/test_rate_limiter.py
+import pytest
+
+import rate_limiter
+from fake_aws import FakeAWS
+
+
+class FakeClock:
+    # Stands in for the time module: sleeping moves the clock forward instead of blocking
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch, tmp_path):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    monkeypatch.setattr(rate_limiter, "STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(rate_limiter, "_buckets", {})
+    monkeypatch.setattr(rate_limiter, "_stats", {})
+    return clock
+
+
+def test_bucket_serves_a_burst_then_waits_for_refill(clock):
+    bucket = rate_limiter.TokenBucket("DetectFaces", 10.0)
+    for _ in range(10):
+        assert bucket.try_take(rate_limiter.INTERACTIVE) == 0.0
+    assert bucket.try_take(rate_limiter.INTERACTIVE) == pytest.approx(0.1)
+    clock.sleep(0.1)
+    assert bucket.try_take(rate_limiter.INTERACTIVE) == 0.0
+
+
+def test_batch_leaves_the_reserve_to_interactive_calls(clock):
+    bucket = rate_limiter.TokenBucket("DetectFaces", 10.0)
+    for _ in range(8):
+        assert bucket.try_take(rate_limiter.BATCH) == 0.0
+    assert bucket.try_take(rate_limiter.BATCH) > 0
+    assert bucket.try_take(rate_limiter.INTERACTIVE) == 0.0
+    assert bucket.try_take(rate_limiter.INTERACTIVE) == 0.0
+
+
+@pytest.mark.parametrize("rate", [0.5, 1.0, 1.25])
+def test_batch_calls_go_through_at_low_rates(clock, rate):
+    with rate_limiter.priority(rate_limiter.BATCH):
+        for _ in range(3):
+            rate_limiter.acquire("Slow")
+    # Three calls take about two refill periods at most
+    assert clock.now - 1000.0 <= 2 / rate + rate_limiter.MAX_SLEEP
+
+
+def test_rate_must_be_positive(clock):
+    with pytest.raises(ValueError):
+        rate_limiter.TokenBucket("DetectFaces", 0.0)
+
+
+def test_throttling_halves_the_rate_then_recovers(clock):
+    bucket = rate_limiter.TokenBucket("DetectFaces", 10.0)
+    bucket.throttled()
+    assert bucket.current_rate() == pytest.approx(5.0)
+    clock.sleep(rate_limiter.DECREASE_WINDOW)
+    bucket.throttled()
+    halved = (5.0 + 10.0 * rate_limiter.RECOVERY_PER_SECOND * rate_limiter.DECREASE_WINDOW) / 2
+    assert bucket.current_rate() == pytest.approx(halved)
+    # The bucket is drained
+    assert bucket.try_take(rate_limiter.INTERACTIVE) > 0
+
+    clock.sleep(1.0)
+    assert bucket.current_rate() == pytest.approx(halved + 10.0 * rate_limiter.RECOVERY_PER_SECOND)
+    clock.sleep(100.0)
+    assert bucket.current_rate() == 10.0
+
+
+def test_rate_does_not_fall_below_the_minimum(clock, monkeypatch):
+    monkeypatch.setattr(rate_limiter, "RECOVERY_PER_SECOND", 0.0)
+    bucket = rate_limiter.TokenBucket("DetectFaces", 10.0)
+    for _ in range(20):
+        bucket.throttled()
+        clock.sleep(rate_limiter.DECREASE_WINDOW)
+    assert bucket.current_rate() == pytest.approx(10.0 * rate_limiter.MIN_RATE_SHARE)
+
+
+def test_a_burst_of_throttling_errors_halves_the_rate_once(clock):
+    bucket = rate_limiter.TokenBucket("DetectFaces", 50.0)
+    for _ in range(8):
+        bucket.throttled()
+    assert bucket.current_rate() == pytest.approx(25.0)
+    # Every error still drains the bucket
+    assert bucket.try_take(rate_limiter.INTERACTIVE) > 0
+
+
+def test_call_retries_throttled_calls(clock):
+    answers = {"FaceDetails": []}
+    attempts = []
+
+    def detect(**kwargs):
+        attempts.append(kwargs)
+        if len(attempts) < 3:
+            raise rate_limiter.ClientError({"Error": {"Code": "ThrottlingException"}}, "DetectFaces")
+        return answers
+
+    assert rate_limiter.call("DetectFaces", detect, Image={}) is answers
+    assert len(attempts) == 3
+    assert rate_limiter.stats()["DetectFaces"]["levels"][rate_limiter.INTERACTIVE]["throttled"] == 2
+
+
+def test_call_gives_up_after_max_attempts(clock):
+    def detect(**kwargs):
+        raise rate_limiter.ClientError({"Error": {"Code": "ThrottlingException"}}, "DetectFaces")
+
+    with pytest.raises(rate_limiter.RekognitionThrottled) as raised:
+        rate_limiter.call("DetectFaces", detect)
+    assert raised.value.retry_after > 0
+    assert rate_limiter.stats()["DetectFaces"]["levels"][rate_limiter.INTERACTIVE]["throttled"] == rate_limiter.MAX_ATTEMPTS
+
+
+def test_other_errors_are_not_retried(clock):
+    attempts = []
+
+    def detect(**kwargs):
+        attempts.append(kwargs)
+        raise rate_limiter.ClientError({"Error": {"Code": "InvalidImageFormatException"}}, "DetectFaces")
+
+    with pytest.raises(rate_limiter.ClientError):
+        rate_limiter.call("DetectFaces", detect)
+    assert len(attempts) == 1
+
+
+def test_throttled_request_gets_429_with_retry_after(clock):
+    import api
+
+    aws = FakeAWS(throttle_rate=1.0)
+    aws.seed_grid("bucket", "grid.png")
+    with aws.installed():
+        response = api.app.test_client().post(
+            "/moderation", json={"bucket": "bucket", "img_path": "grid.png"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert aws.calls[("rekognition", "DetectModerationLabels")] == rate_limiter.MAX_ATTEMPTS
+    assert aws.calls[("rekognition_throttled", "DetectModerationLabels")] == rate_limiter.MAX_ATTEMPTS
+
+
+def test_stats_keep_the_rates_apart_from_the_priorities(clock):
+    rate_limiter.acquire("DetectFaces")
+    with rate_limiter.priority(rate_limiter.BATCH):
+        rate_limiter.acquire("DetectFaces")
+    report = rate_limiter.stats()["DetectFaces"]
+    assert set(report["levels"]) == {rate_limiter.INTERACTIVE, rate_limiter.BATCH}
+    assert all(values["calls"] == 1 for values in report["levels"].values())
+    assert report["max_rate"] == rate_limiter.DEFAULT_TPS["DetectFaces"]
+    assert report["rate"] == report["max_rate"]